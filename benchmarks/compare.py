@@ -0,0 +1,67 @@
+"""Compare two results files saved by benchmarks.run
+
+Usage: python -m benchmarks.compare BASELINE.json NEW.json [--threshold PERCENT]
+
+Changes larger than the threshold are flagged. Exits with 1 if any benchmark got slower than that,
+so this can gate a build.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True if a bigger value is better
+METRICS = {
+    'ops_per_second': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'alloc_peak_bytes_per_call': False,
+}
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(old, new):
+    if old == 0:
+        return 0.0 if new == 0 else float('inf')
+    return (new - old) / old * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='percentage to flag a change (default: 10)')
+    args = parser.parse_args()
+
+    baseline = load(args.baseline)
+    new = load(args.new)
+    print('{} -> {}'.format(baseline['commit'], new['commit']))
+
+    regressed = False
+    for name, new_result in new['benchmarks'].items():
+        old_result = baseline['benchmarks'].get(name)
+        if old_result is None:
+            print('\n{}: new benchmark'.format(name))
+            continue
+
+        print('\n{}:'.format(name))
+        for metric, bigger_is_better in METRICS.items():
+            percent = change(old_result[metric], new_result[metric])
+            worse = percent < 0 if bigger_is_better else percent > 0
+            flag = ''
+            if abs(percent) >= args.threshold:
+                flag = 'WORSE' if worse else 'better'
+                regressed = regressed or worse
+
+            print('  {:<28} {:>14.4f} -> {:>14.4f} {:>+8.1f}% {}'.format(
+                metric, old_result[metric], new_result[metric], percent, flag))
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Timing and allocation measurements shared by all the benchmarks"""
+import asyncio
+import gc
+import statistics
+import time
+import tracemalloc
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, concurrency=1):
+    latencies = sorted(latencies)
+    return {
+        'iterations': len(latencies),
+        'concurrency': concurrency,
+        'ops_per_second': len(latencies) / elapsed if elapsed else float('inf'),
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def measure_allocations(call, iterations):
+    """Average bytes allocated by one call: at its peak, and still held after it returned
+
+    Only this process is traced, so the work done in worker processes isn't counted.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        retained_total = 0
+        for _ in range(iterations):
+            # Forget the earlier allocations, so that only the ones made by this call are counted
+            tracemalloc.clear_traces()
+            call()
+            retained, peak = tracemalloc.get_traced_memory()
+            peak_total += peak
+            retained_total += retained
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'alloc_peak_bytes_per_call': peak_total / iterations,
+        'alloc_retained_bytes_per_call': retained_total / iterations,
+    }
+
+
+def run_sync(function, iterations, warmup, alloc_iterations):
+    for _ in range(warmup):
+        function()
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+
+    result = summarize(latencies, elapsed)
+    result.update(measure_allocations(function, alloc_iterations))
+    return result
+
+
+async def _run_concurrently(coroutine_function, iterations, concurrency):
+    latencies = []
+    remaining = iter(range(iterations))
+
+    async def client():
+        for _ in remaining:
+            call_start = time.perf_counter()
+            await coroutine_function()
+            latencies.append(time.perf_counter() - call_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+def run_async(coroutine_function, iterations, warmup, alloc_iterations, concurrency=1):
+    """Run iterations calls, at most concurrency of them at the same time, on a fresh event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_run_concurrently(coroutine_function, warmup, concurrency))
+        latencies, elapsed = loop.run_until_complete(_run_concurrently(coroutine_function, iterations, concurrency))
+
+        result = summarize(latencies, elapsed, concurrency)
+        result.update(measure_allocations(lambda: loop.run_until_complete(coroutine_function()), alloc_iterations))
+        return result
+    finally:
+        loop.close()
@@ -0,0 +1,226 @@
+"""Offline benchmarks for the Python hot paths of the bots
+
+Usage: python -m benchmarks.run [--filter NAME] [--iterations N] [--output FILE]
+
+SQF-VM is replaced by a stand-in library built from stub_sqfvm.c (a C compiler is needed), and the Biki pages
+are read from fixtures/biki, so nothing is downloaded. The results are printed and saved as JSON in
+benchmarks/results/<commit>.json. Compare two runs with benchmarks.compare.
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import types
+
+from benchmarks import harness, stub_library
+from cogs.interpreter import Interpreter
+from modules.command_index import CommandIndex
+from modules.discord_utils import escape_markdown
+from modules.mediawiki import SQFCommand, parse_mediawiki_textarea
+from sqfvm_wrapper import SQFVMLibrary, SQFVMWrapper
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_PATH = os.path.join(BENCHMARKS_PATH, 'fixtures', 'biki')
+COMMANDS_PATH = os.path.join(BENCHMARKS_PATH, 'fixtures', 'commands.txt')
+RESULTS_PATH = os.path.join(BENCHMARKS_PATH, 'results')
+
+BOT_USER_ID = 779302146624094208
+SQF_SNIPPET = '\n'.join(['private _units = allUnits select {alive _x};',
+                         '{ _x setDamage 0 } forEach _units;',
+                         'count _units'] * 10)
+# Typo -> command that must be suggested for it
+COMMAND_TYPOS = {
+    'hnit': 'hint',
+    'gtePos': 'getPos',
+    'froEach': 'forEach',
+    'getPso': 'getPos',
+    'allUntis': 'allUnits',
+    'craeteVehicle': 'createVehicle',
+    'setDri': 'setDir',
+    'isNill': 'isNil',
+}
+
+
+def load_fixtures():
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_PATH, '*.wiki'))):
+        with open(path, encoding='utf-8') as f:
+            fixtures[os.path.splitext(os.path.basename(path))[0]] = f.read()
+    return fixtures
+
+
+# ==== Benchmarks =============================================================
+# Each one takes the run options and returns the result of a harness.run_* function
+
+def bench_escape_markdown(options):
+    return harness.run_sync(lambda: escape_markdown(SQF_SNIPPET, 'sqf'), **options)
+
+
+def bench_escape_markdown_truncated(options):
+    text = SQF_SNIPPET * 10  # Over the 2000 characters limit
+    return harness.run_sync(lambda: escape_markdown(text, 'sqf'), **options)
+
+
+def bench_strip_mentions_and_markdown(options):
+    cog = types.SimpleNamespace(bot=types.SimpleNamespace(user=types.SimpleNamespace(id=BOT_USER_ID)))
+    message = types.SimpleNamespace(content='<@!{}> ```sqf\n{}```'.format(BOT_USER_ID, SQF_SNIPPET),
+                                    raw_mentions=[BOT_USER_ID])
+    return harness.run_sync(lambda: Interpreter.strip_mentions_and_markdown(cog, message), **options)
+
+
+def bench_parse_mediawiki_textarea(options):
+    pages = list(load_fixtures().values())
+
+    def parse_all():
+        for page in pages:
+            parse_mediawiki_textarea(page)
+
+    return harness.run_sync(parse_all, **options)
+
+
+def bench_sqf_command(options):
+    templates = [(name, parse_mediawiki_textarea(page)) for name, page in load_fixtures().items()]
+
+    def parse_all():
+        for name, template in templates:
+            SQFCommand(name, template)
+
+    return harness.run_sync(parse_all, **options)
+
+
+def bench_command_index_search(options):
+    with open(COMMANDS_PATH, encoding='utf-8') as f:
+        index = CommandIndex(f.read().split())
+
+    # Not worth timing if the suggestions are wrong
+    for typo, command in COMMAND_TYPOS.items():
+        suggestions = index.search(typo)
+        if command not in suggestions:
+            raise AssertionError('{} not suggested for {}: {}'.format(command, typo, suggestions))
+
+    def search_all():
+        for typo in COMMAND_TYPOS:
+            index.search(typo)
+
+    return harness.run_sync(search_all, **options)
+
+
+def _bench_call_type(options, output_lines):
+    stub_library.configure(latency_ms=0, output_lines=output_lines)
+    library = SQFVMLibrary(stub_library.build(), max_instance_calls=20, max_output_bytes=64 * 1024)
+    library.load()
+    try:
+        return harness.run_sync(lambda: library.call_sqf(SQF_SNIPPET), **options)
+    finally:
+        library.unload()
+
+
+def bench_call_type(options):
+    return _bench_call_type(options, output_lines=1)
+
+
+def bench_call_type_large_output(options):
+    return _bench_call_type(options, output_lines=2000)
+
+
+def bench_call_type_async(options):
+    """Round trip through the worker pool, with enough concurrent calls to keep every worker busy"""
+    stub_library.configure(latency_ms=5, output_lines=10)
+    workers = 4
+    wrapper = SQFVMWrapper(stub_library.build(), workers=workers, max_instance_calls=20, warm_instances=1,
+                           max_output_bytes=64 * 1024)
+    wrapper.load()
+    try:
+        return harness.run_async(lambda: wrapper.call_sqf_async(SQF_SNIPPET), concurrency=workers * 2, **options)
+    finally:
+        wrapper.unload()
+
+
+# name -> (function, fraction of --iterations to run)
+BENCHMARKS = {
+    'escape_markdown': (bench_escape_markdown, 1),
+    'escape_markdown_truncated': (bench_escape_markdown_truncated, 1),
+    'strip_mentions_and_markdown': (bench_strip_mentions_and_markdown, 1),
+    'parse_mediawiki_textarea': (bench_parse_mediawiki_textarea, 0.1),
+    'sqf_command': (bench_sqf_command, 0.1),
+    'command_index_search': (bench_command_index_search, 0.1),
+    'call_type': (bench_call_type, 1),
+    'call_type_large_output': (bench_call_type_large_output, 0.05),
+    'call_type_async': (bench_call_type_async, 0.1),
+}
+
+
+# ==== / Benchmarks ===========================================================
+
+def get_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, check=True,
+                                text=True, cwd=BENCHMARKS_PATH).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               check=True, text=True, cwd=BENCHMARKS_PATH).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+    return commit, dirty
+
+
+def print_results(results):
+    header = '{:<30} {:>12} {:>10} {:>10} {:>10} {:>14}'.format(
+        'benchmark', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'alloc B/call')
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        print('{:<30} {:>12.1f} {:>10.4f} {:>10.4f} {:>10.4f} {:>14.0f}'.format(
+            name, result['ops_per_second'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['alloc_peak_bytes_per_call']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', action='append', default=[],
+                        help='only run the benchmarks whose name contains this text (can be repeated)')
+    parser.add_argument('--iterations', type=int, default=5000, help='timed calls of the fastest benchmarks')
+    parser.add_argument('--output', help='where to save the results (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--no-save', action='store_true', help="don't save the results")
+    args = parser.parse_args()
+
+    commit, dirty = get_commit()
+    results = {}
+    for name, (function, fraction) in BENCHMARKS.items():
+        if args.filter and not any(text in name for text in args.filter):
+            continue
+
+        iterations = max(10, int(args.iterations * fraction))
+        options = {
+            'iterations': iterations,
+            'warmup': max(1, iterations // 10),
+            'alloc_iterations': max(1, iterations // 10),
+        }
+        print('Running {} ({} iterations)...'.format(name, iterations), file=sys.stderr)
+        results[name] = function(options)
+
+    print_results(results)
+
+    if args.no_save:
+        return
+
+    output = args.output or os.path.join(RESULTS_PATH, '{}{}.json'.format(commit, '-dirty' if dirty else ''))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'dirty': dirty,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'benchmarks': results,
+        }, f, indent=2)
+    print('Results saved to {}'.format(output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
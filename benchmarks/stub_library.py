@@ -0,0 +1,37 @@
+"""Builds the stand-in libcsqfvm from stub_sqfvm.c"""
+import os
+import platform
+import subprocess
+
+STUB_SOURCE = os.path.join(os.path.dirname(__file__), 'stub_sqfvm.c')
+BUILD_PATH = os.path.join(os.path.dirname(__file__), 'build')
+
+
+def get_library_path():
+    if platform.system() == 'Windows':
+        name = 'sqfvm_stub.dll'
+    elif platform.system() == 'Darwin':
+        name = 'libsqfvm_stub.dylib'
+    else:
+        name = 'libsqfvm_stub.so'
+    return os.path.join(BUILD_PATH, name)
+
+
+def build(compiler=None):
+    """Compile the stub if it's missing or older than its source and return its path"""
+    path = get_library_path()
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(STUB_SOURCE):
+        return path
+
+    os.makedirs(BUILD_PATH, exist_ok=True)
+    compiler = compiler or os.environ.get('CC', 'cc')
+    subprocess.run([compiler, '-O2', '-shared', '-fPIC', '-fvisibility=hidden', '-o', path, STUB_SOURCE],
+                   check=True)
+    return path
+
+
+def configure(latency_ms=0, output_lines=1, line_bytes=32):
+    """Set the behaviour of the stub. Worker processes started afterwards inherit it"""
+    os.environ['SQFVM_STUB_LATENCY_MS'] = str(latency_ms)
+    os.environ['SQFVM_STUB_OUTPUT_LINES'] = str(output_lines)
+    os.environ['SQFVM_STUB_LINE_BYTES'] = str(line_bytes)
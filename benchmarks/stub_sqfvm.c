@@ -0,0 +1,106 @@
+/*
+ * Stand-in for libcsqfvm that implements the same C ABI, for benchmarking the Python side offline.
+ *
+ * Every sqfvm_call sleeps for SQFVM_STUB_LATENCY_MS milliseconds and then logs SQFVM_STUB_OUTPUT_LINES lines
+ * of SQFVM_STUB_LINE_BYTES bytes each. The environment is read on every call.
+ * Code starting with "parse_error" returns -3, like SQF-VM does for code that can't be parsed.
+ */
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#if defined(_WIN32)
+#include <windows.h>
+#define EXPORT __declspec(dllexport)
+#else
+#define EXPORT __attribute__((visibility("default")))
+#endif
+
+typedef void (*sqfvm_log_callback)(void* user_data, void* call_data, int32_t severity, const char* message,
+                                   uint32_t length);
+
+typedef struct {
+    void* user_data;
+    sqfvm_log_callback callback;
+    float max_runtime_seconds;
+    int running;
+} stub_instance;
+
+static long env_long(const char* name, long fallback) {
+    const char* value = getenv(name);
+    return value && *value ? strtol(value, NULL, 10) : fallback;
+}
+
+static void sleep_ms(long ms) {
+    if (ms <= 0) {
+        return;
+    }
+#if defined(_WIN32)
+    Sleep((DWORD)ms);
+#else
+    struct timespec duration = {ms / 1000, (ms % 1000) * 1000000L};
+    nanosleep(&duration, NULL);
+#endif
+}
+
+EXPORT void* sqfvm_create_instance(void* user_data, sqfvm_log_callback callback, float max_runtime_seconds) {
+    stub_instance* instance = calloc(1, sizeof(stub_instance));
+    if (instance) {
+        instance->user_data = user_data;
+        instance->callback = callback;
+        instance->max_runtime_seconds = max_runtime_seconds;
+    }
+    return instance;
+}
+
+EXPORT void sqfvm_destroy_instance(void* instance) {
+    free(instance);
+}
+
+EXPORT int32_t sqfvm_load_config(void* instance, const char* contents, uint32_t length) {
+    (void)contents;
+    (void)length;
+    return instance ? 0 : -1;
+}
+
+EXPORT int32_t sqfvm_call(void* instance_ptr, void* call_data, char type, const char* code, uint32_t length) {
+    stub_instance* instance = instance_ptr;
+    long lines, line_bytes, i;
+    char* line;
+
+    if (!instance) {
+        return -1;
+    }
+    if (instance->running) {
+        return -4;
+    }
+    if (!strchr("sc1ap", type)) {
+        return -5;
+    }
+    if (length >= 11 && strncmp(code, "parse_error", 11) == 0) {
+        return -3;
+    }
+
+    instance->running = 1;
+    sleep_ms(env_long("SQFVM_STUB_LATENCY_MS", 0));
+
+    lines = env_long("SQFVM_STUB_OUTPUT_LINES", 1);
+    line_bytes = env_long("SQFVM_STUB_LINE_BYTES", 32);
+    line = malloc(line_bytes + 1);
+    if (line) {
+        memset(line, 'x', line_bytes);
+        line[line_bytes] = '\0';
+        for (i = 0; i < lines; i++) {
+            instance->callback(instance->user_data, call_data, 0, line, (uint32_t)line_bytes);
+        }
+        free(line);
+    }
+
+    instance->running = 0;
+    return 0;
+}
+
+EXPORT int32_t sqfvm_status(void* instance) {
+    return instance ? 0 : -1;
+}
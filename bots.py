@@ -12,6 +12,7 @@ class SQFBot(BotBase):
         'cogs.restart',
         'cogs.interpreter',
         'cogs.wiki',
+        'cogs.stats',
     ]
 
     def __init__(self, bot_data):
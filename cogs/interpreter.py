@@ -1,63 +1,198 @@
+import asyncio
 import logging
+import re
 
 import discord
 from discord.ext import commands
 
+import checks
 import settings
-from modules.discord_utils import escape_markdown
+from discord_base import periodic_command
+from modules.discord_utils import StreamingReply, combine_code_blocks, send_message
+from modules.lru_cache import LRUCache
+from modules.output_delivery import OutputDelivery
+from modules.scheduler import FairScheduler, SchedulerFull
 from sqfvm_wrapper import SQFVMWrapper
 
 logger = logging.getLogger('discord.' + __name__)
 
+# Every fenced block, with the language it's tagged with, if any
+CODE_BLOCK_PATTERN = re.compile(r'```(?:(?P<language>sqf2sqc|sqf|sqc|assembly|preprocess)(?!\w)|[^\s`]*\n)?'
+                                r'(?P<code>.*?)```', re.DOTALL)
+
+
+class TrackedReply:
+    """Reply of the bot, remembered so that it can be updated when the message it answered is edited"""
+
+    def __init__(self, reply, default_function, follow_languages, strip_command_marker):
+        self.reply = reply
+        self.default_function = default_function
+        self.follow_languages = follow_languages
+        self.strip_command_marker = strip_command_marker
+        self.blocks = []  # (function name, code) of each block, in order
+        self.results = {}  # (function name, code) -> result
+
 
 class Interpreter(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.interpreter_enabled = True
+
+        # Everything on_message needs to know about the start of a message, found with a single match
+        self.dispatch_pattern = re.compile(r'{}(?P<command>\S+)|```(?P<language>sqf2sqc|sqf|sqc|assembly|preprocess)'
+                                           .format(re.escape(self.bot.command_prefix)))
+        self.executors = {
+            'sqf': self.execute_sqf,
+            'sqc': self.execute_sqc,
+            'sqf2sqc': self.execute_sqf2sqc,
+            'assembly': self.execute_assembly,
+            'preprocess': self.execute_preprocess,
+        }
+        self.eligible_channels = {}  # channel id -> whether ```sqX blocks are interpreted there
+        self.delivery = OutputDelivery(max_pages=settings.OUTPUT_MAX_PAGES,
+                                       memory_budget=settings.OUTPUT_PAGES_MAX_BYTES,
+                                       gzip_attachments=settings.OUTPUT_GZIP_ATTACHMENTS)
+        self.replies = LRUCache(max_entries=settings.SQFVM_TRACKED_REPLIES)  # message id -> TrackedReply
         # Store the wrapper in the bot namespace to be able to access it from other cogs
-        self.bot.sqfvm = SQFVMWrapper(settings.SQFVM_LIB_PATH)
+        self.bot.sqfvm = SQFVMWrapper(settings.SQFVM_LIB_PATH,
+                                      workers=settings.SQFVM_WORKERS,
+                                      max_instance_calls=settings.SQFVM_INSTANCE_MAX_CALLS,
+                                      warm_instances=settings.SQFVM_WARM_INSTANCES,
+                                      max_output_bytes=settings.SQFVM_MAX_OUTPUT_BYTES,
+                                      cached_types=[ord(t) for t in settings.SQFVM_CACHED_TYPES],
+                                      cache_max_entries=settings.SQFVM_CACHE_MAX_ENTRIES,
+                                      cache_max_bytes=settings.SQFVM_CACHE_MAX_BYTES,
+                                      config_files=settings.SQFVM_CONFIG_FILES,
+                                      deadline_grace=settings.SQFVM_DEADLINE_GRACE,
+                                      nodes=settings.SQFVM_NODES,
+                                      node_token=settings.SQFVM_NODE_TOKEN,
+                                      health_interval=settings.SQFVM_NODE_HEALTH_INTERVAL)
+        # One slot per worker, so that the scripts wait in the fair queue and not in the worker pool.
+        # With execution nodes, the workers are only known once they answer, see update_queue_slots
+        self.scheduler = FairScheduler(max(1, self.bot.sqfvm.capacity()),
+                                       max_queued=settings.SQFVM_QUEUE_MAX,
+                                       max_queued_per_user=settings.SQFVM_QUEUE_MAX_PER_USER,
+                                       max_queued_per_channel=settings.SQFVM_QUEUE_MAX_PER_CHANNEL)
         try:
             self.bot.sqfvm.load()
         except:
             # Continue working because you can later call "!rebuild" to get SQF-VM working again
             logger.exception('Could not load SQF-VM!')
 
-    async def execute_sqf(self, code):
+    async def execute_sqf(self, code, on_output=None):
         if self.bot.sqfvm.ready():
-            retval = await self.bot.sqfvm.call_sqf_async(code)
+            retval = await self.bot.sqfvm.call_sqf_async(code, on_output=on_output)
         else:
             retval = "SQF-VM not ready. Try again later"
         return retval
 
-    async def execute_sqc(self, code):
+    async def execute_sqc(self, code, on_output=None):
         if self.bot.sqfvm.ready():
-            retval = await self.bot.sqfvm.call_sqc_async(code)
+            retval = await self.bot.sqfvm.call_sqc_async(code, on_output=on_output)
         else:
             retval = "SQF-VM not ready. Try again later"
         return retval
 
-    async def execute_sqf2sqc(self, code):
+    async def execute_sqf2sqc(self, code, on_output=None):
         if self.bot.sqfvm.ready():
-            retval = await self.bot.sqfvm.call_sqf2sqc_async(code)
+            retval = await self.bot.sqfvm.call_sqf2sqc_async(code, on_output=on_output)
         else:
             retval = "SQF-VM not ready. Try again later"
         return retval
 
-    async def execute_assembly(self, code):
+    async def execute_assembly(self, code, on_output=None):
         if self.bot.sqfvm.ready():
-            retval = await self.bot.sqfvm.call_assembly_async(code)
+            retval = await self.bot.sqfvm.call_assembly_async(code, on_output=on_output)
         else:
             retval = "SQF-VM not ready. Try again later"
         return retval
 
-    async def execute_preprocess(self, code):
+    async def execute_preprocess(self, code, on_output=None):
         if self.bot.sqfvm.ready():
-            retval = await self.bot.sqfvm.call_preprocess_async(code)
+            retval = await self.bot.sqfvm.call_preprocess_async(code, on_output=on_output)
         else:
             retval = "SQF-VM not ready. Try again later"
         return retval
 
+    async def execute_and_reply(self, message, default_function, blocks, follow_languages=True,
+                                strip_command_marker=False):
+        """Execute the code blocks at the same time and reply with their results
+
+        Blocks run with the function of their language, or with default_function if they have none or
+        follow_languages is False. A single block shows its partial output while it's running.
+        Each block waits for its turn in the fair queue. The author is told where they are in it, or that they
+        need to try again later if it's full.
+        If the message was already answered, its reply is updated instead, and only the blocks that changed
+        are run again.
+        """
+        channel = message.channel
+        ignored = len(blocks) - settings.SQFVM_MAX_CODE_BLOCKS
+        blocks = blocks[:settings.SQFVM_MAX_CODE_BLOCKS]
+
+        functions = [self.executors[language] if follow_languages and language else default_function
+                     for language, code in blocks]
+        keys = [(function.__name__, code) for function, (language, code) in zip(functions, blocks)]
+
+        tracked = self.replies.get(message.id)
+        previous_results = tracked.results if tracked else {}
+        if tracked and tracked.blocks == keys:
+            return  # Nothing to run again, and the reply would be the same
+        to_run = [i for i, key in enumerate(keys) if key not in previous_results]
+
+        try:
+            jobs = self.scheduler.submit_many(message.author.id, channel.id, len(to_run))
+        except SchedulerFull as e:
+            await send_message(channel, str(e))
+            return
+
+        # Every job has to be entered or cancelled, or its slot is lost. Sending to Discord may raise before that
+        try:
+            # The blocks are queued in order, so only the first one tells if the others have to wait for someone
+            position = jobs[0].position() if jobs else 0
+            if position:
+                await send_message(channel, 'SQF-VM is busy, you are #{} in queue'.format(position))
+
+            reply = tracked.reply if tracked else None
+            results = [previous_results.get(key) for key in keys]
+
+            if len(blocks) == 1 and to_run:
+                streaming = StreamingReply(channel, language='sqf', delivery=self.delivery, message=reply)
+                async with jobs[0], channel.typing():
+                    results[0] = await functions[0](blocks[0][1], on_output=streaming.feed)
+                reply = await streaming.finish(results[0])
+
+            else:
+                async def run(i, job):
+                    async with job:
+                        results[i] = await functions[i](blocks[i][1])
+
+                async with channel.typing():
+                    await asyncio.gather(*(run(i, job) for i, job in zip(to_run, jobs)))
+
+                if len(blocks) == 1:
+                    reply = await self.delivery.send(channel, results[0], 'sqf', reply)
+                else:
+                    titles = ['Block {} ({}):'.format(i, function.__name__[len('execute_'):])
+                              for i, function in enumerate(functions, 1)]
+                    content = combine_code_blocks(list(zip(titles, results)), language='sqf')
+                    if ignored > 0:
+                        content += '\n(only the first {} blocks were run)'.format(settings.SQFVM_MAX_CODE_BLOCKS)
+                    reply = await self.delivery.replace(channel, reply, content=content)
+        finally:
+            for job in jobs:
+                job.cancel()  # Does nothing to the jobs that have run
+
+        tracked = TrackedReply(reply, default_function, follow_languages, strip_command_marker)
+        tracked.blocks = keys
+        tracked.results = dict(zip(keys, results))
+        self.replies.put(message.id, tracked)
+
     def strip_mentions_and_markdown(self, message, strip_command_marker=False):
+        """Return the code of the message as [(language, code)], one per fenced block
+
+        The language is None for blocks that aren't tagged with one. A message without any fenced block is
+        taken as a single block of code.
+        """
         content = message.content.strip()
 
         if strip_command_marker:
@@ -71,18 +206,11 @@ class Interpreter(commands.Cog):
                 content = content[12:]
 
         if self.bot.user.id in message.raw_mentions:
-            content = content.replace('<@!{}>'.format(self.bot.user.id), '')
+            for mention in ('<@!{}>', '<@{}>'):
+                content = content.replace(mention.format(self.bot.user.id), '')
 
-        if content.startswith('```sqf2sqc') and content.endswith('```'):
-            content = content[10:-3]
-        elif (content.startswith('```sqf') or content.startswith('```sqc')) and content.endswith('```'):
-            content = content[6:-3]
-        elif content.startswith('```assembly') and content.endswith('```'):
-            content = content[11:-3]
-        elif content.startswith('```preprocess') and content.endswith('```'):
-            content = content[13:-3]
-
-        return content
+        blocks = [match.group('language', 'code') for match in CODE_BLOCK_PATTERN.finditer(content)]
+        return blocks or [(None, content)]
 
     @commands.command()
     async def sqf(self, ctx):
@@ -95,11 +223,10 @@ class Interpreter(commands.Cog):
         - Enclose your message in an ``'sqf block
           if the channel name starts with "sqf" or "sqc"
         """
-        code_to_execute = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
+        blocks = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
 
-        async with ctx.typing():
-            result = await self.execute_sqf(code_to_execute)
-        await ctx.channel.send(escape_markdown(result, language='sqf'))
+        await self.execute_and_reply(ctx.message, self.execute_sqf, blocks, follow_languages=False,
+                                     strip_command_marker=True)
 
     @commands.command()
     async def sqc(self, ctx):
@@ -112,11 +239,10 @@ class Interpreter(commands.Cog):
         - Enclose your message in an ``'sqc block
           if the channel name starts with "sqf" or "sqc"
         """
-        code_to_execute = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
+        blocks = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
 
-        async with ctx.typing():
-            result = await self.execute_sqc(code_to_execute)
-        await ctx.channel.send(escape_markdown(result, language='sqf'))
+        await self.execute_and_reply(ctx.message, self.execute_sqc, blocks, follow_languages=False,
+                                     strip_command_marker=True)
 
     @commands.command()
     async def sqf2sqc(self, ctx):
@@ -129,11 +255,10 @@ class Interpreter(commands.Cog):
         - Enclose your message in an ``'sqf2sqc block
           if the channel name starts with "sqf" or "sqc"
         """
-        code_to_execute = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
+        blocks = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
 
-        async with ctx.typing():
-            result = await self.execute_sqf2sqc(code_to_execute)
-        await ctx.channel.send(escape_markdown(result, language='sqf'))
+        await self.execute_and_reply(ctx.message, self.execute_sqf2sqc, blocks, follow_languages=False,
+                                     strip_command_marker=True)
 
     @commands.command()
     async def assembly(self, ctx):
@@ -145,11 +270,10 @@ class Interpreter(commands.Cog):
         - Enclose your message in an ``'assembly block
           if the channel name starts with "sqf" or "sqc"
         """
-        code_to_execute = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
+        blocks = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
 
-        async with ctx.typing():
-            result = await self.execute_assembly(code_to_execute)
-        await ctx.channel.send(escape_markdown(result, language='sqf'))
+        await self.execute_and_reply(ctx.message, self.execute_assembly, blocks, follow_languages=False,
+                                     strip_command_marker=True)
 
     @commands.command()
     async def preprocess(self, ctx):
@@ -161,11 +285,76 @@ class Interpreter(commands.Cog):
         - Enclose your message in an ``'preprocess block
           if the channel name starts with "sqf" or "sqc"
         """
-        code_to_execute = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
+        blocks = self.strip_mentions_and_markdown(ctx.message, strip_command_marker=True)
+
+        await self.execute_and_reply(ctx.message, self.execute_preprocess, blocks, follow_languages=False,
+                                     strip_command_marker=True)
+
+    @periodic_command(10)
+    async def update_queue_slots(self):
+        """Follow the number of workers of the execution nodes that are up"""
+        self.scheduler.resize(max(1, self.bot.sqfvm.capacity()))
+
+    @periodic_command(60)
+    async def reload_changed_configs(self):
+        if self.bot.sqfvm.ready() and self.bot.sqfvm.configs_changed():
+            logger.info('SQF-VM config files changed, reloading them')
+            self.bot.sqfvm.reload_configs()
+
+    @commands.command()
+    @checks.only_admins()
+    async def sqfvm_cache(self, ctx):
+        """Show the statistics of the SQF-VM results cache"""
+        stats = self.bot.sqfvm.results_cache.stats()
+        await self.delivery.send(ctx.channel, '\n'.join(f'{key}: {value}' for key, value in stats.items()))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if payload.user_id != self.bot.user.id:
+            await self.delivery.turn_page(payload.message_id, str(payload.emoji))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        # Removing a reaction turns the page too, so that users don't need to click twice
+        if payload.user_id != self.bot.user.id:
+            await self.delivery.turn_page(payload.message_id, str(payload.emoji))
+
+    def is_eligible_channel(self, channel):
+        try:
+            return self.eligible_channels[channel.id]
+        except KeyError:
+            eligible = isinstance(channel, discord.TextChannel) and channel.name.startswith(('sqf', 'sqc'))
+            self.eligible_channels[channel.id] = eligible
+            return eligible
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        self.eligible_channels.pop(after.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.eligible_channels.pop(channel.id, None)
+
+    def dispatch(self, message):
+        """Return the function that should interpret the message, or None if the message is not for us
+
+        This runs for every message the bot sees, so it's kept as cheap as possible.
+        """
+        match = self.dispatch_pattern.match(message.content)
+        language = None
+        if match:
+            # Valid commands are handled by the commands themselves
+            if match.group('command') and self.bot.get_command(match.group('command')):
+                return None
+            language = match.group('language')
 
-        async with ctx.typing():
-            result = await self.execute_preprocess(code_to_execute)
-        await ctx.channel.send(escape_markdown(result, language='sqf'))
+        if language and self.is_eligible_channel(message.channel):
+            return self.executors[language]
+
+        if isinstance(message.channel, discord.DMChannel) or self.bot.user in message.mentions:
+            return self.execute_sqf
+
+        return None
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -176,48 +365,37 @@ class Interpreter(commands.Cog):
         - Is in a DM channel
         - Mentions the bot
         - Is in a channel named "sqf..." and is in an sqf block
+        Every fenced block of the message is run, with the language it's tagged with
         """
 
         # Ignore messages coming from bots
         if message.author.bot:
             return
 
-        # If this is a valid command, ignore this message
-        ctx = await self.bot.get_context(message)
-        if ctx.command:
+        function_to_execute = self.dispatch(message)
+        if function_to_execute is None:
             return
 
-        code_to_execute = None
-        function_to_execute = self.execute_sqf  # Default
+        blocks = [block for block in self.strip_mentions_and_markdown(message) if block[1]]
+        if blocks:
+            await self.execute_and_reply(message, function_to_execute, blocks)
 
-        if self.bot.user.id in message.raw_mentions:
-            code_to_execute = self.strip_mentions_and_markdown(message)
-
-        elif type(message.channel) is discord.DMChannel:  # Always interpret when DM
-            code_to_execute = self.strip_mentions_and_markdown(message)
-
-        # Don't use elif here because the ```sqX may override the language type to execute
-        if message.channel.name.startswith('sqf') or message.channel.name.startswith('sqc'):
-            if message.content.startswith('```sqf2sqc'):
-                code_to_execute = self.strip_mentions_and_markdown(message)
-                function_to_execute = self.execute_sqf2sqc
-            elif message.content.startswith('```sqf'):
-                code_to_execute = self.strip_mentions_and_markdown(message)
-                function_to_execute = self.execute_sqf
-            elif message.content.startswith('```sqc'):
-                code_to_execute = self.strip_mentions_and_markdown(message)
-                function_to_execute = self.execute_sqc
-            elif message.content.startswith('```assembly'):
-                code_to_execute = self.strip_mentions_and_markdown(message)
-                function_to_execute = self.execute_assembly
-            elif message.content.startswith('```preprocess'):
-                code_to_execute = self.strip_mentions_and_markdown(message)
-                function_to_execute = self.execute_preprocess
-
-        if code_to_execute:
-            async with message.channel.typing():
-                sqf_result = await function_to_execute(code_to_execute)
-            await message.channel.send(escape_markdown(sqf_result, language='sqf'))
+    @commands.Cog.listener()
+    async def on_message_edit(self, before, after):
+        """Update the reply to an edited message that was interpreted, running again only the blocks that changed"""
+        # Discord also reports an edit when it adds the preview of a link
+        if after.author.bot or before.content == after.content:
+            return
+
+        tracked = self.replies.get(after.id)
+        if tracked is None:
+            return
+
+        blocks = [block for block in self.strip_mentions_and_markdown(after, tracked.strip_command_marker)
+                  if block[1]]
+        if blocks:
+            await self.execute_and_reply(after, tracked.default_function, blocks, tracked.follow_languages,
+                                         tracked.strip_command_marker)
 
 
 def setup(bot):
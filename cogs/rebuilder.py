@@ -1,8 +1,11 @@
 import asyncio
+import glob
 import logging
 import os
 import platform
+import shutil
 import subprocess
+import time
 
 from discord.ext import commands
 
@@ -15,8 +18,15 @@ logger = logging.getLogger('discord.' + __name__)
 class FancyProgress:
     def __init__(self):
         self.messages = []
+        self.state_start = None
 
     def next_state(self, state):
+        # Show how long the previous state took
+        now = time.monotonic()
+        if self.state_start is not None:
+            self.messages[-1] += ' ({:.1f}s)'.format(now - self.state_start)
+        self.state_start = now
+
         self.messages.append(state)
         return self  # So that we can chain calls
 
@@ -44,9 +54,49 @@ class Rebuilder(commands.Cog):
             logger.info('Running: %s', ' '.join(command))
             subprocess.run(command, check=True, cwd=settings.VMPATH)
 
+    def get_head(self):
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, cwd=settings.VMPATH,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+    def get_built_head(self):
+        """Commit of the last build that has been successfully loaded, if any"""
+        try:
+            with open(os.path.join(settings.SQFVM_BUILDS_PATH, 'built_commit')) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def set_built_head(self, head):
+        with open(os.path.join(settings.SQFVM_BUILDS_PATH, 'built_commit'), 'w') as f:
+            f.write(head)
+
+    def cmake_files_changed(self, old_head, new_head):
+        diff = subprocess.run(['git', 'diff', '--name-only', old_head, new_head], cwd=settings.VMPATH,
+                              stdout=subprocess.PIPE, universal_newlines=True)
+        if diff.returncode != 0:
+            return True  # old_head is gone, e.g. after a force push. Better safe than sorry
+
+        changed_files = diff.stdout.splitlines()
+        return any(os.path.basename(path) == 'CMakeLists.txt' or path.endswith('.cmake') for path in changed_files)
+
     def call_cmake(self):
+        # Build out of the source tree, so that the library currently loaded is never overwritten.
+        # A cache left by the former in-source builds would make CMake configure the source tree instead
+        try:
+            os.remove(os.path.join(settings.VMPATH, 'CMakeCache.txt'))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(os.path.join(settings.VMPATH, 'CMakeFiles'), ignore_errors=True)
+
+        os.makedirs(settings.SQFVM_BUILD_PATH, exist_ok=True)
         new_env = dict(os.environ, **settings.BUILD_ENV)  # Add envs just for this command
-        subprocess.run(['cmake', '.'], check=True, cwd=settings.VMPATH, env=new_env)
+        command = ['cmake', '-S', os.path.abspath(settings.VMPATH), '-B', os.path.abspath(settings.SQFVM_BUILD_PATH)]
+
+        # Reuse the objects of previous builds, even after the build directory has been reconfigured
+        if settings.BUILD_USE_CCACHE and shutil.which('ccache'):
+            command.extend(['-DCMAKE_C_COMPILER_LAUNCHER=ccache', '-DCMAKE_CXX_COMPILER_LAUNCHER=ccache'])
+
+        subprocess.run(command, check=True, cwd=settings.SQFVM_BUILD_PATH, env=new_env)
 
     def build_sqfvm(self):
         command =['cmake', '--build', '.', '--target', 'libcsqfvm']
@@ -54,15 +104,61 @@ class Rebuilder(commands.Cog):
         # msbuild on Windows is already doing parallel building
         # and adding the "parallel" switch actually PREVENTS from doing that
         if platform.system() == 'Linux':
-            command.extend(['--parallel', '6'])
+            command.extend(['--parallel', str(os.cpu_count() or 1)])
+
+        subprocess.run(command, check=True, cwd=settings.SQFVM_BUILD_PATH)
 
-        subprocess.run(command, check=True, cwd=settings.VMPATH)
+    def stage_sqfvm(self):
+        """Copy the freshly built library to a new, versioned, file name and return its path
+
+        A name that has never been loaded is needed to be sure to load the new build and not the one in memory
+        """
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, cwd=settings.VMPATH,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+        name, extension = os.path.splitext(os.path.basename(settings.SQFVM_LIB_PATH))
+        staged_path = os.path.join(settings.SQFVM_BUILDS_PATH, '{}-{}-{}{}'.format(
+            name, time.strftime('%Y%m%d%H%M%S'), commit, extension))
+
+        os.makedirs(settings.SQFVM_BUILDS_PATH, exist_ok=True)
+        shutil.copy2(settings.SQFVM_BUILD_OUTPUT, staged_path)
+        return staged_path
+
+    def install_sqfvm(self, staged_path):
+        """Make the staged library the one loaded on startup and delete the oldest staged builds"""
+        temporary_path = settings.SQFVM_LIB_PATH + '.new'
+        shutil.copy2(staged_path, temporary_path)
+        try:
+            os.replace(temporary_path, settings.SQFVM_LIB_PATH)  # Atomic, and safe even if the file is loaded
+        except OSError:
+            # Windows won't replace a loaded DLL. The new build will still be used until the next restart
+            logger.exception('Could not install %s as %s', staged_path, settings.SQFVM_LIB_PATH)
+            os.remove(temporary_path)
+
+        name, extension = os.path.splitext(os.path.basename(settings.SQFVM_LIB_PATH))
+        staged_builds = sorted(glob.glob(os.path.join(settings.SQFVM_BUILDS_PATH, name + '-*' + extension)))
+        for path in staged_builds[:-settings.SQFVM_KEEP_BUILDS]:
+            if path != staged_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Probably still loaded, on Windows
 
     @commands.command()
     @checks.only_admins()
-    async def rebuild(self, ctx):
-        """Update and rebuild SQF-VM"""
+    async def rebuild(self, ctx, mode: str = 'incremental'):
+        """
+        Update and rebuild SQF-VM
+
+        By default, nothing is built if there are no new commits, and cmake is only rerun if the cmake files
+        have changed. Use "!rebuild full" to reconfigure and rebuild anyway.
+        """
+        if self.bot.sqfvm.nodes:
+            # The builds loaded here would never be used, the calls run on the nodes
+            await ctx.channel.send('SQF-VM runs on the execution nodes, rebuild it there and restart them')
+            return
+
         progress = FancyProgress()
+        full_rebuild = mode == 'full'
 
         async def _run_asynchronously(message_text, sync_function, *sync_args):
             """Small wrapper to better call synchronous shell commands
@@ -77,33 +173,45 @@ class Rebuilder(commands.Cog):
                 return False
             return True
 
-        message = await ctx.channel.send(progress.next_state('Unloading SQF-VM...'))
+        # The current build keeps serving requests until the new one is ready
+        message = await ctx.channel.send(progress.next_state('Rebuilding SQF-VM...'))
 
         try:
             async with ctx.typing():
-                self.bot.sqfvm.unload()
-
                 # git pull
                 if not await _run_asynchronously('Pulling changes...', self.git_pull):
                     return
+                built_head = self.get_built_head()
+                new_head = self.get_head()
 
-                # rm CMakeCache.txt
-                await message.edit(content=progress.next_state('Deleting CmakeCache.txt'))
-                try:
-                    os.remove(os.path.join(settings.VMPATH, 'CMakeCache.txt'))
-                except FileNotFoundError:
-                    pass
-
-                # cmake .
-                if not await _run_asynchronously('Running cmake...', self.call_cmake):
+                if new_head == built_head and self.bot.sqfvm.ready() and not full_rebuild:
+                    await message.edit(content=progress.next_state('No new commits, nothing to build'))
+                    await ctx.channel.send('SQF-VM is already up to date!')
                     return
 
+                cmake_cache = os.path.join(settings.SQFVM_BUILD_PATH, 'CMakeCache.txt')
+                if (full_rebuild or built_head is None or not os.path.exists(cmake_cache) or
+                        self.cmake_files_changed(built_head, new_head)):
+                    # rm CMakeCache.txt
+                    await message.edit(content=progress.next_state('Deleting CmakeCache.txt'))
+                    try:
+                        os.remove(cmake_cache)
+                    except FileNotFoundError:
+                        pass
+
+                    # cmake .
+                    if not await _run_asynchronously('Running cmake...', self.call_cmake):
+                        return
+
                 # make libsqfvm
                 if not await _run_asynchronously('Building...', self.build_sqfvm):
                     return
 
                 await message.edit(content=progress.next_state('Loading SQF-VM...'))
-                self.bot.sqfvm.load()
+                staged_path = self.stage_sqfvm()
+                self.bot.sqfvm.swap(staged_path)  # Raises and keeps the current build if loading fails
+                self.install_sqfvm(staged_path)
+                self.set_built_head(new_head)
 
                 if self.bot.sqfvm.ready():
                     await message.edit(content=progress.next_state('SQF-VM is ready!'))
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from discord.ext import commands
+
+import checks
+import settings
+from modules import metrics
+from modules.discord_utils import send_message
+from modules.output_delivery import OutputDelivery
+
+logger = logging.getLogger('discord.' + __name__)
+
+
+class Stats(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+        self.delivery = OutputDelivery(max_pages=settings.OUTPUT_MAX_PAGES)
+
+        if settings.METRICS_PORT:
+            asyncio.ensure_future(self.start_server())
+
+    def cog_unload(self):
+        if self.runner:
+            asyncio.ensure_future(self.runner.cleanup())
+
+    async def start_server(self):
+        """Serve the metrics on /metrics, for Prometheus to scrape"""
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, settings.METRICS_HOST, settings.METRICS_PORT).start()
+        except OSError:
+            logger.exception('Could not serve the metrics on %s:%s', settings.METRICS_HOST, settings.METRICS_PORT)
+            await runner.cleanup()
+            return
+
+        self.runner = runner
+        logger.info('Serving metrics on http://%s:%s/metrics', settings.METRICS_HOST, settings.METRICS_PORT)
+
+    async def handle_metrics(self, request):
+        return web.Response(body=metrics.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    @staticmethod
+    def format_labels(metric, key):
+        return ' '.join('{}={}'.format(name, value) for name, value in zip(metric.label_names, key)) or 'total'
+
+    def format_metrics(self):
+        lines = []
+        for metric in metrics.get_metrics():
+            summary = metric.summary()
+            if not summary:
+                continue
+
+            lines.append(metric.name)
+            for key, value in summary.items():
+                if isinstance(metric, metrics.Histogram):
+                    value = 'n={count} mean={mean:.4g} p50={p50:.4g} p95={p95:.4g}'.format(**value)
+                lines.append('  {}: {}'.format(self.format_labels(metric, key), value))
+
+        return '\n'.join(lines) or 'Nothing measured yet'
+
+    @commands.command()
+    @checks.only_admins()
+    async def stats(self, ctx):
+        """Show the latency and usage statistics of the bot (seconds, bytes)"""
+        await self.delivery.send(ctx.channel, self.format_metrics())
+
+    def format_jobs(self):
+        lines = []
+        for name, stats in self.bot.scheduler.stats().items():
+            if stats['running']:
+                state = 'running'
+            elif stats['next_run_in'] is not None:
+                state = 'next run in {:.0f}s'.format(stats['next_run_in'])
+            else:
+                state = 'not started'
+            lines.append('{} (every {}s, {}): runs={runs} failures={failures} overruns={overruns}'.format(
+                name, stats['interval'], state, **stats))
+            if stats['runs']:
+                lines.append('  duration: last={last_duration:.3f} mean={mean_duration:.3f} max={max_duration:.3f}'
+                             .format(**stats))
+            if stats['consecutive_failures']:
+                lines.append('  failed {consecutive_failures} times in a row, last error: {last_error}'.format(**stats))
+
+        return '\n'.join(lines) or 'No periodic job'
+
+    @commands.command()
+    @checks.only_admins()
+    async def jobs(self, ctx):
+        """Show the periodic jobs of the bot and how their runs went (seconds)"""
+        await self.delivery.send(ctx.channel, self.format_jobs())
+
+    @commands.command()
+    @checks.only_admins()
+    async def run_job(self, ctx, name: str):
+        """Run a periodic job now, like Wiki.fetch_commands (see !jobs)"""
+        if name not in self.bot.scheduler.jobs:
+            await send_message(ctx.channel,
+                               'Unknown job! Available: {}'.format(', '.join(sorted(self.bot.scheduler.jobs))))
+        elif self.bot.scheduler.run_now(name):
+            await send_message(ctx.channel, '{} will run now'.format(name))
+        else:
+            await send_message(ctx.channel, '{} is already running'.format(name))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if payload.user_id != self.bot.user.id:
+            await self.delivery.turn_page(payload.message_id, str(payload.emoji))
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        if payload.user_id != self.bot.user.id:
+            await self.delivery.turn_page(payload.message_id, str(payload.emoji))
+
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
@@ -1,26 +1,117 @@
+import asyncio
 import logging
+import time
 
 import discord
 from discord.ext import commands
 
 # import checks
+import settings
 from discord_base import periodic_command
-from modules.discord_utils import escape_markdown
-from modules.mediawiki import get_list, get_page, parse_mediawiki_textarea, SQFCommand
+from modules.biki_store import BikiStore, sync
+from modules.command_index import CommandIndex
+from modules.discord_utils import escape_markdown, send_message
+from modules.lru_cache import LRUCache
+from modules.mediawiki import close_session, get_page, parse_sqf_command, SQFCommand
 
 logger = logging.getLogger('discord.' + __name__)
 
+SYNC_INTERVAL = 3600  # Seconds
+
 
 class Wiki(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.commands = {}
+        self.store = BikiStore(settings.BIKI_DB_PATH)
+        self.commands = self.store.urls()  # Available right away, and even if the wiki is down
+        self.index = CommandIndex(self.commands)
+        logger.info('Loaded %d commands from the local Biki index', len(self.commands))
+        self.first_sync = True
+
+        # Parsed commands and ready to send embeds, dropped as soon as a new revision of their page is fetched
+        self.parsed_commands = LRUCache(max_entries=settings.BIKI_PARSED_CACHE_SIZE)
+        self.embeds = LRUCache(max_entries=settings.BIKI_EMBED_CACHE_SIZE)  # (name, variant) -> (version, embed)
+
+    def cog_unload(self):
+        self.store.close()
+        asyncio.ensure_future(close_session())
 
-    @periodic_command(3600)
+    @periodic_command(SYNC_INTERVAL)
     async def fetch_commands(self):
-        logger.info('Fetching list of commands...')
-        self.commands = await get_list()
-        logger.info('Fetched %d commands', len(self.commands))
+        # Right after a restart, the local index may still be recent enough
+        if self.first_sync:
+            self.first_sync = False
+            last_sync = self.store.get_meta('last_sync')
+            if last_sync is not None and time.time() - float(last_sync) < SYNC_INTERVAL:
+                logger.info('The local Biki index was synced less than %d seconds ago', SYNC_INTERVAL)
+                return
+
+        fetched = await sync(self.store, concurrency=settings.BIKI_CRAWL_CONCURRENCY,
+                             full_sync_interval=settings.BIKI_FULL_SYNC_INTERVAL)
+        self.commands = self.store.urls()
+        self.index.update(self.commands)
+        self.invalidate(fetched)
+        logger.info('Updated %d pages of the local Biki index', len(fetched))
+
+    def invalidate(self, names):
+        for name in names:
+            self.parsed_commands.pop(name)
+            for variant in ('short', 'full', 'sqc'):
+                self.embeds.pop((name, variant))
+
+    async def resolve(self, ctx, name):
+        """Return the actual name of the command, or None after replying with the closest names"""
+        match = self.index.lookup(name)  # Ignores the case, unless that's ambiguous
+        if match is not None:
+            return match
+
+        suggestions = self.index.search(name)
+        if suggestions:
+            await send_message(ctx.channel, 'Unknown command! Did you mean: {}?'.format(', '.join(suggestions)))
+        else:
+            await send_message(ctx.channel, 'Unknown command!')
+        return None
+
+    async def get_command(self, name, command_url_part):
+        """Get the command from the local index, or from the wiki if its page hasn't been indexed yet"""
+        sqf_command = self.parsed_commands.get(name)
+        if sqf_command is not None:
+            return sqf_command
+
+        entry = self.store.get(name)
+        if entry and entry['parsed']:
+            sqf_command = SQFCommand.from_dict(entry['parsed'])
+        else:
+            page_contents = await get_page(command_url_part.replace('/wiki/', ''))
+            sqf_command = parse_sqf_command(name, page_contents)
+
+            # Without a revision, the next crawl will fetch it again anyway
+            self.store.put_page(name, None, page_contents, sqf_command.to_dict())
+
+        self.parsed_commands.put(name, sqf_command)
+        return sqf_command
+
+    async def get_embed(self, name, command_url_part, variant):
+        """Get the embed of the command for the given variant ('short', 'full' or 'sqc'), building it if needed"""
+        # SQC examples are transpiled, so they depend on the SQF-VM build too
+        version = None
+        if variant == 'sqc':
+            sqfvm = getattr(self.bot, 'sqfvm', None)
+            version = sqfvm.build_id if sqfvm and sqfvm.ready() else None
+
+        cached = self.embeds.get((name, variant))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        sqf_command = await self.get_command(name, command_url_part)
+        if variant == 'short':
+            embed = self.build_embed(name, command_url_part, sqf_command)
+        else:
+            embed = await self.build_full_embed(name, command_url_part, sqf_command, to_sqc=variant == 'sqc')
+
+        if variant != 'sqc' or version is not None:  # Don't keep examples that SQF-VM couldn't transpile
+            self.embeds.put((name, variant), (version, embed))
+        return embed
 
     # def add_syntax_field(self, embed, syntax, parameters, return_value):
     #     embed.add_field(name='-------------',
@@ -52,38 +143,48 @@ class Wiki(commands.Cog):
         """
         Get the description of a command from the Biki
         """
-        try:
-            command_url_part = self.commands[name]
-        except KeyError:
-            await ctx.channel.send('Unknown command!')
+        name = await self.resolve(ctx, name)
+        if name is None:
             return
+        command_url_part = self.commands[name]
 
         async with ctx.typing():
-            page_contents = await get_page(command_url_part.replace('/wiki/', ''))
-            template = parse_mediawiki_textarea(page_contents)
-            sqf_command = SQFCommand(name, template)
+            embed = await self.get_embed(name, command_url_part, 'short')
 
-        embed = discord.Embed(title=name, url=f'https://community.bistudio.com/{command_url_part}',
-                              description=sqf_command.description)
-
-        await ctx.channel.send(embed=embed)
+        await send_message(ctx.channel, embed=embed)
 
     @biki.error
     async def biki_error(self, ctx, error):
-        await ctx.channel.send(error)
+        await send_message(ctx.channel, error)
+
+    @commands.command()
+    async def biki_search(self, ctx, text: str):
+        """
+        Find the commands whose name starts with, or is close to, the given text
+        """
+        matches = self.index.search(text, limit=15)
+        await send_message(ctx.channel, ', '.join(matches) if matches else 'No matching command!')
+
+    @biki_search.error
+    async def biki_search_error(self, ctx, error):
+        await send_message(ctx.channel, error)
 
     async def _biki_full(self, ctx, name: str, to_sqc=False):
-        try:
-            command_url_part = self.commands[name]
-        except KeyError:
-            await ctx.channel.send('Unknown command!')
+        name = await self.resolve(ctx, name)
+        if name is None:
             return
+        command_url_part = self.commands[name]
 
         async with ctx.typing():
-            page_contents = await get_page(command_url_part.replace('/wiki/', ''))
-            template = parse_mediawiki_textarea(page_contents)
-            sqf_command = SQFCommand(name, template)
+            embed = await self.get_embed(name, command_url_part, 'sqc' if to_sqc else 'full')
+
+        await send_message(ctx.channel, embed=embed)
+
+    def build_embed(self, name, command_url_part, sqf_command):
+        return discord.Embed(title=name, url=f'https://community.bistudio.com/{command_url_part}',
+                             description=sqf_command.description)
 
+    async def build_full_embed(self, name, command_url_part, sqf_command, to_sqc=False):
         embed = discord.Embed(title=name, url=f'https://community.bistudio.com/{command_url_part}',
                               description=sqf_command.description)
         # embed.set_author(name=sqf_command.type)#, url="asd", icon_url="asd")
@@ -103,7 +204,7 @@ class Wiki(commands.Cog):
                             inline=False)
 
         embed.set_footer(text=f'See also: {sqf_command.see_also}\nGroups: {",".join(sqf_command.command_groups)}')
-        await ctx.channel.send(embed=embed)
+        return embed
 
     @commands.command()
     async def biki_full(self, ctx, name: str):
@@ -114,7 +215,7 @@ class Wiki(commands.Cog):
 
     @biki_full.error
     async def biki_full_error(self, ctx, error):
-        await ctx.channel.send(error)
+        await send_message(ctx.channel, error)
 
     @commands.command()
     async def biki_sqc(self, ctx, name: str):
@@ -125,7 +226,7 @@ class Wiki(commands.Cog):
 
     @biki_sqc.error
     async def biki_sqc_error(self, ctx, error):
-        await ctx.channel.send(error)
+        await send_message(ctx.channel, error)
 
 
 def setup(bot):
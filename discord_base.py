@@ -1,21 +1,195 @@
 import asyncio
 import inspect
 import logging
+import math
+import random
 import time
 
 from discord.ext import commands
 
+from modules import metrics
+
 logger = logging.getLogger('discord.' + __name__)
 bots = []
 
+PERIODIC_RUNS = metrics.counter('periodic_runs_total', 'Runs of the periodic jobs', ['job', 'result'])
+PERIODIC_DURATION = metrics.histogram('periodic_duration_seconds', 'Time the periodic jobs took to run', ['job'])
+PERIODIC_OVERRUNS = metrics.counter('periodic_overruns_total', 'Runs of the periodic jobs that took longer than '
+                                                               'their interval', ['job'])
+
 
 def get_bots():
     return bots
 
 
+class PeriodicJob:
+    """Function run every interval seconds by a PeriodicScheduler
+
+    - Each delay is randomly lengthened or shortened by up to `jitter` (a fraction of it), so that jobs started
+      together don't keep running at the same time.
+    - After consecutive failures, the delay doubles each time, up to max_backoff seconds.
+    - overrun tells what happens when a run takes longer than the interval, or run_now is called during a run:
+      'skip' waits for the next turn that hasn't been missed, 'queue' runs once more right away.
+      Runs of a job never overlap, and never pile up.
+    """
+
+    def __init__(self, name, function, interval, jitter=0.1, max_backoff=None, overrun='skip'):
+        if overrun not in ('skip', 'queue'):
+            raise ValueError('Unknown overrun policy: {}'.format(overrun))
+
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff if max_backoff is not None else interval * 8
+        self.overrun = overrun
+
+        self.task = None
+        self.triggered = asyncio.Event()
+        self.running = False
+        self.next_run = None  # time.monotonic() value
+
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.overruns = 0
+        self.total_duration = 0
+        self.max_duration = 0
+        self.last_duration = None
+        self.last_error = None
+
+    def _jittered(self, delay):
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def run_once(self):
+        """Run the function and record how it went. Return when it started and ended"""
+        self.running = True
+        started = time.monotonic()
+        try:
+            await self.function()
+        except Exception as e:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = '{}: {}'.format(type(e).__name__, e)
+            PERIODIC_RUNS.inc(job=self.name, result='failure')
+            logger.exception('Periodic job %s failed (%d in a row)', self.name, self.consecutive_failures)
+        else:
+            self.consecutive_failures = 0
+            PERIODIC_RUNS.inc(job=self.name, result='success')
+        finally:
+            self.running = False
+
+        ended = time.monotonic()
+        duration = ended - started
+        self.runs += 1
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        self.last_duration = duration
+        PERIODIC_DURATION.observe(duration, job=self.name)
+        return started, ended
+
+    def schedule_after(self, started, ended):
+        """Time of the next run, after a run that went from started to ended"""
+        if self.consecutive_failures:
+            return ended + self._jittered(min(self.interval * 2 ** self.consecutive_failures, self.max_backoff))
+
+        if ended - started < self.interval:
+            return started + self._jittered(self.interval)
+
+        self.overruns += 1
+        PERIODIC_OVERRUNS.inc(job=self.name)
+        if self.overrun == 'queue':
+            return ended
+        # The next turn that is still to come, as if the run had taken no time
+        return started + self.interval * math.ceil((ended - started) / self.interval)
+
+    async def loop(self, bot):
+        await bot.wait_until_ready()
+        while not bot.ws:
+            await asyncio.sleep(1)
+
+        self.next_run = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self.triggered.wait(), max(0, self.next_run - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            self.triggered.clear()
+
+            started, ended = await self.run_once()
+            self.next_run = self.schedule_after(started, ended)
+
+    def run_now(self):
+        """Run the job as soon as possible. Return False if it's running and its overrun policy is 'skip'"""
+        if self.running and self.overrun == 'skip':
+            return False
+        self.triggered.set()
+        return True
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'overruns': self.overruns,
+            'mean_duration': self.total_duration / self.runs if self.runs else None,
+            'max_duration': self.max_duration,
+            'last_duration': self.last_duration,
+            'last_error': self.last_error,
+            'running': self.running,
+            'next_run_in': max(0, self.next_run - time.monotonic()) if self.next_run and not self.running else None,
+        }
+
+
+class PeriodicScheduler:
+    """Owner of all the periodic jobs of a bot. Jobs start running once the scheduler is started"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.jobs = {}  # name -> PeriodicJob
+        self.started = False
+
+    def add(self, job):
+        """Add the job, replacing the one with the same name"""
+        self.remove(job.name)
+        self.jobs[job.name] = job
+        if self.started:
+            job.task = self.bot.loop.create_task(job.loop(self.bot))
+
+    def remove(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None and job.task is not None:
+            job.task.cancel()
+
+    def start(self):
+        """Start the jobs and return their tasks"""
+        self.started = True
+        for job in self.jobs.values():
+            if job.task is None:
+                job.task = self.bot.loop.create_task(job.loop(self.bot))
+        return [job.task for job in self.jobs.values()]
+
+    def stop(self):
+        self.started = False
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+                job.task = None
+
+    def run_now(self, name):
+        """Run the job as soon as possible. Return False if it's already running and won't run again for this"""
+        return self.jobs[name].run_now()
+
+    def stats(self):
+        return {name: job.stats() for name, job in sorted(self.jobs.items())}
+
+
 class BotBase(commands.Bot):
     def __init__(self, *args, **kwargs):
-        self.periodic_commands = []
+        self.created_at = time.perf_counter()
+        self.startup_logged = False
+        self.scheduler = PeriodicScheduler(self)
         super().__init__(*args, **kwargs)
 
         # Load commands and periodic commands declared in cogs
@@ -36,6 +210,11 @@ class BotBase(commands.Bot):
         logger.info(self.user.id)
         logger.info('------')
 
+        # on_ready is called again after reconnecting
+        if not self.startup_logged:
+            self.startup_logged = True
+            logger.info('Ready %.2f seconds after creating the bot', time.perf_counter() - self.created_at)
+
         while not self.ws:
             await asyncio.sleep(0.1)
 
@@ -45,23 +224,26 @@ class BotBase(commands.Bot):
 
     def load_extensions(self):
         for extension in self.startup_extensions:
+            start = time.perf_counter()
             try:
                 self.load_extension(extension)
             except Exception as e:
                 exc = '{}: {}'.format(type(e).__name__, e)
                 logger.error('Failed to load extension %s\n%s', extension, exc)
+            else:
+                logger.info('Loaded extension %s in %.2f seconds', extension, time.perf_counter() - start)
 
-    def add_periodic_command(self, member, interval):
-        logger.info('Registering periodic command every {} seconds: {}'.format(
-            interval, member.__name__))
-        self.periodic_commands.append((member, interval))
+    def add_periodic_command(self, member, options):
+        job = PeriodicJob(member.__qualname__, member, **options)
+        logger.info('Registering periodic command every {} seconds: {}'.format(job.interval, job.name))
+        self.scheduler.add(job)
 
     def load_extra_commands(self, object):
         members = inspect.getmembers(object)
         for name, member in members:
-            registered_periodic_command_interval = getattr(member, '_registered_periodic_command_interval', None)
-            if registered_periodic_command_interval:
-                self.add_periodic_command(member, registered_periodic_command_interval)
+            options = getattr(member, '_periodic_command_options', None)
+            if options:
+                self.add_periodic_command(member, options)
 
     def add_cog(self, cog):
         retval = super().add_cog(cog)
@@ -69,51 +251,36 @@ class BotBase(commands.Bot):
 
         return retval
 
-    async def periodic(self, function, interval):
-        await self.wait_until_ready()
-
-        while not self.ws:
-            await asyncio.sleep(1)
+    def remove_cog(self, name):
+        cog = self.get_cog(name)
+        for job in list(self.scheduler.jobs.values()):
+            if cog is not None and getattr(job.function, '__self__', None) is cog:
+                self.scheduler.remove(job.name)
 
-        while True:
-            start = time.time()
-            try:
-                await function()
-            except Exception:
-                import traceback
-                traceback.print_exc()
+        return super().remove_cog(name)
 
-            end = time.time()
-            # adjust interval
-            adjusted_interval = max(interval - end + start, 0)
-            await asyncio.sleep(adjusted_interval)
+    async def close(self):
+        self.scheduler.stop()
+        await super().close()
 
 
 # Decorator that marks a given bot function as a periodic command to be
-# executed every interval seconds.
-def periodic_command(interval):
+# executed every interval seconds. See PeriodicJob for the other options.
+def periodic_command(interval, jitter=0.1, max_backoff=None, overrun='skip'):
     def real_decorator(function):
-        def wrapper(*args, **kwargs):
-            return function(*args, **kwargs)
-
-        wrapper._registered_periodic_command_interval = interval
-        return wrapper
+        function._periodic_command_options = {
+            'interval': interval, 'jitter': jitter, 'max_backoff': max_backoff, 'overrun': overrun,
+        }
+        return function
     return real_decorator
 
 
 def create_bot(cls, arg):
-    """Utility function for creating a bot and registering its periodic functions."""
-    tasks = []
+    """Utility function for creating a bot and starting its periodic functions."""
     bots = get_bots()
 
     bot = cls(arg)
     bots.append(bot)
     bot.loop.create_task(bot.start(bot.bot_data['bot_token']))
 
-    # Register periodic functions
-    for (function, registered_periodic_command_interval) in bot.periodic_commands:
-        logger.info('Creating future: {}'.format(function))
-        task = bot.loop.create_task(bot.periodic(function, registered_periodic_command_interval))
-        tasks.append(task)
-
-    return tasks
+    return bot.scheduler.start()
@@ -1,19 +1,22 @@
 #!/usr/bin/env python
+import time
+STARTED = time.perf_counter()
+
 import logging
 
-from discord_base import create_bot, get_bots
+import settings
+from modules.log_pipeline import setup_logging
 
-FORMAT = '%(asctime)-15s:%(levelname)s:%(name)s: %(message)s'
-logging.basicConfig(level=logging.INFO, format=FORMAT)
+log_listener = setup_logging(settings.LOG_FILE, level=settings.LOG_LEVEL, json_lines=settings.LOG_JSON,
+                             rotate_bytes=settings.LOG_ROTATE_BYTES, rotate_when=settings.LOG_ROTATE_WHEN,
+                             backup_count=settings.LOG_BACKUP_COUNT, compress=settings.LOG_COMPRESS)
 logger = logging.getLogger('discord')
-logger.setLevel(logging.INFO)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8')
-handler.setFormatter(logging.Formatter(FORMAT))
-logger.addHandler(handler)
 
 import asyncio
-import settings
 from bots import SQFBot
+from discord_base import create_bot, get_bots
+
+logger.info('Imported the modules in %.2f seconds', time.perf_counter() - STARTED)
 
 
 def wakeup():
@@ -55,6 +58,7 @@ def main():
 
     finally:
         loop.close()
+        log_listener.stop()  # Write what's left in the queue
 
 
 if __name__ == '__main__':
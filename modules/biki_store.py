@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from modules.mediawiki import (API_BATCH_SIZE, get_category_members, get_list, get_pages, get_recent_changes,
+                               get_revisions, get_url_part, parse_sqf_command)
+
+logger = logging.getLogger('discord.' + __name__)
+
+SYNC_OVERLAP = 300  # Seconds
+
+
+class BikiStore:
+    """Local copy of the Biki page of every command, along with the fields parsed from it"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS commands (
+                    name TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    revision INTEGER,
+                    wikitext TEXT,
+                    parsed TEXT,
+                    fetched_at REAL
+                )
+            ''')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def get(self, name):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT url, revision, wikitext, parsed, fetched_at FROM commands WHERE name = ?', (name,)).fetchone()
+
+        if row is None:
+            return None
+
+        url, revision, wikitext, parsed, fetched_at = row
+        return {
+            'name': name,
+            'url': url,
+            'revision': revision,
+            'wikitext': wikitext,
+            'parsed': json.loads(parsed) if parsed else None,
+            'fetched_at': fetched_at,
+        }
+
+    def urls(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT name, url FROM commands'))
+
+    def revisions(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT name, revision FROM commands'))
+
+    def set_urls(self, commands):
+        """Make the store hold exactly the given {name: url} commands, keeping the pages already fetched"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO commands (name, url) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET url = excluded.url',
+                commands.items())
+
+            known = {name for (name,) in self.connection.execute('SELECT name FROM commands')}
+            self.connection.executemany('DELETE FROM commands WHERE name = ?',
+                                        [(name,) for name in known - commands.keys()])
+
+    def put_page(self, name, revision, wikitext, parsed):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE commands SET revision = ?, wikitext = ?, parsed = ?, fetched_at = ? WHERE name = ?',
+                (revision, wikitext, json.dumps(parsed) if parsed else None, time.time(), name))
+
+
+def parse_command(name, wikitext):
+    """Return the fields of the command described by the wikitext, or None if the page can't be parsed"""
+    try:
+        return parse_sqf_command(name, wikitext).to_dict()
+    except Exception:
+        logger.warning('Could not parse the Biki page of %s', name, exc_info=True)
+        return None
+
+
+def _store_pages(store, pages):
+    for name, (revision, wikitext) in pages.items():
+        store.put_page(name, revision, wikitext, parse_command(name, wikitext))
+
+
+def _batches(names):
+    return [names[i:i + API_BATCH_SIZE] for i in range(0, len(names), API_BATCH_SIZE)]
+
+
+async def _fetch_outdated(store, names, concurrency):
+    """Fetch the pages of the commands that are not in the store yet or whose page has a newer revision
+
+    Pages are requested API_BATCH_SIZE at a time, at most `concurrency` requests at once.
+    Return the names of the commands whose page was fetched, and whether all the batches succeeded.
+    """
+    loop = asyncio.get_event_loop()
+    known_revisions = store.revisions()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_batch(batch):
+        async with semaphore:
+            # Checking the revisions first is only worth it if some of the pages could be up to date
+            outdated = batch
+            if any(known_revisions.get(name) for name in batch):
+                revisions = await get_revisions(batch)
+                outdated = [name for name in batch if name in revisions and revisions[name] != known_revisions[name]]
+
+            if not outdated:
+                return []
+
+            pages = await get_pages(outdated)
+
+        # Parsing is slow enough to be kept off the event loop
+        await loop.run_in_executor(None, _store_pages, store, pages)
+        return list(pages)
+
+    results = await asyncio.gather(*(fetch_batch(batch) for batch in _batches(names)), return_exceptions=True)
+
+    fetched = []
+    complete = True
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error('Could not fetch a batch of Biki pages', exc_info=result)
+            complete = False
+        else:
+            fetched.extend(result)
+
+    return fetched, complete
+
+
+async def crawl(store, commands, concurrency=4):
+    """Bring the store up to date with the {name: url} commands, checking the revision of every page
+
+    Return the names of the commands whose page was fetched, and whether all of them could be checked
+    """
+    await asyncio.get_event_loop().run_in_executor(None, store.set_urls, commands)
+    return await _fetch_outdated(store, sorted(commands), concurrency)
+
+
+async def update(store, since, concurrency=4):
+    """Apply the changes made on the wiki since the timestamp: new, edited, moved and deleted commands
+
+    Return the names of the commands whose page was fetched, and whether all of them could be checked
+    """
+    changed = await get_recent_changes(since)
+    if not changed:
+        return [], True
+
+    # The change may have added the page to the category of commands, or removed it
+    members = set()
+    for batch in _batches(sorted(changed)):
+        members.update(await get_category_members(batch))
+
+    commands = store.urls()
+    for title in changed:
+        if title in members:
+            commands[title] = get_url_part(title)
+        else:
+            commands.pop(title, None)
+
+    await asyncio.get_event_loop().run_in_executor(None, store.set_urls, commands)
+    return await _fetch_outdated(store, sorted(members), concurrency)
+
+
+async def sync(store, concurrency=4, full_sync_interval=24 * 3600):
+    """Bring the store up to date with the wiki and return the names of the commands whose page was fetched
+
+    Normally, only the pages changed since the last sync are looked at, which costs a single small request when
+    nothing has changed. Every full_sync_interval seconds, and on the first run, the whole list of commands is
+    downloaded again and the revision of every page is checked, in case a change was missed.
+    """
+    started = time.time()
+    last_sync = store.get_meta('last_sync')
+    last_full_sync = store.get_meta('last_full_sync')
+
+    if last_sync is None or last_full_sync is None or started - float(last_full_sync) > full_sync_interval:
+        logger.info('Fetching list of commands...')
+        commands = await get_list()
+        logger.info('Fetched %d commands', len(commands))
+
+        fetched, complete = await crawl(store, commands, concurrency=concurrency)
+        if complete:
+            store.set_meta('last_full_sync', started)
+    else:
+        # Overlap a bit with the previous sync, in case the clocks don't agree
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(float(last_sync) - SYNC_OVERLAP))
+        fetched, complete = await update(store, since, concurrency=concurrency)
+
+    # Otherwise, the same changes will be looked at again next time
+    if complete:
+        store.set_meta('last_sync', started)
+
+    return fetched
@@ -0,0 +1,140 @@
+import bisect
+import heapq
+from collections import Counter, defaultdict
+
+
+def _trigrams(folded):
+    padded = f'  {folded} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, max_distance):
+    """Edit distance between a and b, counting swapped neighbour characters as a single edit
+
+    Return max_distance + 1 as soon as it's known to be greater than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        left = i
+        for j, char_b in enumerate(b, 1):
+            # Plain comparisons, as this is the hot loop and min() is much slower
+            substitution = previous[j - 1] + (char_a != char_b)
+            deletion = previous[j] + 1
+            insertion = left + 1
+            left = substitution if substitution < deletion else deletion
+            if insertion < left:
+                left = insertion
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b and before_previous[j - 2] + 1 < left:
+                left = before_previous[j - 2] + 1
+            current.append(left)
+
+        if min(current) > max_distance:
+            return max_distance + 1
+        before_previous = previous
+        previous = current
+
+    return previous[-1]
+
+
+class CommandIndex:
+    """In-memory index of the command names, for case-insensitive, prefix and typo-tolerant lookups"""
+
+    def __init__(self, names=()):
+        self.names = {}  # folded name -> names, as a few commands only differ by their case
+        self.sorted_folded = []  # For prefix searches
+        self.trigrams = defaultdict(set)  # trigram -> folded names containing it
+        self.update(names)
+
+    def __len__(self):
+        return sum(len(names) for names in self.names.values())
+
+    def add(self, name):
+        folded = name.casefold()
+        if folded not in self.names:
+            self.names[folded] = []
+            bisect.insort(self.sorted_folded, folded)
+            for trigram in _trigrams(folded):
+                self.trigrams[trigram].add(folded)
+
+        if name not in self.names[folded]:
+            self.names[folded].append(name)
+
+    def remove(self, name):
+        folded = name.casefold()
+        names = self.names.get(folded, [])
+        if name not in names:
+            return
+
+        names.remove(name)
+        if names:
+            return
+
+        del self.names[folded]
+        del self.sorted_folded[bisect.bisect_left(self.sorted_folded, folded)]
+        for trigram in _trigrams(folded):
+            self.trigrams[trigram].discard(folded)
+            if not self.trigrams[trigram]:
+                del self.trigrams[trigram]
+
+    def update(self, names):
+        """Make the index hold exactly the given names, only touching the ones that were added or removed"""
+        names = set(names)
+        current = {name for folded_names in self.names.values() for name in folded_names}
+
+        for name in current - names:
+            self.remove(name)
+        for name in names - current:
+            self.add(name)
+
+    def lookup(self, name):
+        """Return the indexed name matching the given one, ignoring the case if that's not ambiguous"""
+        names = self.names.get(name.casefold(), [])
+        if name in names:
+            return name
+        if len(names) == 1:
+            return names[0]
+        return None
+
+    def search(self, query, limit=5):
+        """Return up to `limit` names similar to the query, best matches first
+
+        Names that start with the query come first, shortest first, then names that are a few typos away.
+        """
+        folded = query.casefold()
+        ranked = []  # (rank, folded name)
+
+        # Prefix matches
+        start = bisect.bisect_left(self.sorted_folded, folded)
+        prefixed = []
+        for candidate in self.sorted_folded[start:]:
+            if not candidate.startswith(folded):
+                break
+            prefixed.append(candidate)
+        ranked.extend(((0, len(candidate)), candidate) for candidate in prefixed)
+
+        # Typos: only compute the edit distance of the names sharing the most trigrams with the query.
+        # Each edit changes at most 4 trigrams (swapping two letters does), and the length by at most 1, so the
+        # other names can't be close enough. They're left out first, so that they don't push the close ones out
+        max_distance = max(1, len(folded) // 4)
+        query_trigrams = _trigrams(folded)
+        min_shared = len(query_trigrams) - 4 * max_distance
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self.trigrams.get(trigram, ()))
+
+        already_ranked = set(prefixed)
+        candidates = [(count, candidate) for candidate, count in shared.items()
+                      if count >= min_shared and abs(len(candidate) - len(folded)) <= max_distance
+                      and candidate not in already_ranked]
+        for _, candidate in heapq.nlargest(limit * 4, candidates):
+            distance = edit_distance(folded, candidate, max_distance)
+            if distance <= max_distance:
+                ranked.append(((1, distance), candidate))
+
+        ranked.sort()
+        return [name for _, folded_name in ranked[:limit] for name in self.names[folded_name]][:limit]
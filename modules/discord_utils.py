@@ -1,3 +1,36 @@
+import asyncio
+import logging
+
+from modules import metrics
+
+logger = logging.getLogger('discord.' + __name__)
+
+DISCORD_SEND = metrics.histogram('discord_send_seconds', 'Time taken to send, edit, delete or react to a reply on '
+                                 'Discord', ['operation'])
+
+
+# Replies go through these, so that DISCORD_SEND measures all of them
+
+async def send_message(channel, content=None, **kwargs):
+    with DISCORD_SEND.time(operation='send'):
+        return await channel.send(content, **kwargs)
+
+
+async def edit_message(message, **kwargs):
+    with DISCORD_SEND.time(operation='edit'):
+        await message.edit(**kwargs)
+
+
+async def delete_message(message):
+    with DISCORD_SEND.time(operation='delete'):
+        await message.delete()
+
+
+async def add_reaction(message, emoji):
+    with DISCORD_SEND.time(operation='react'):
+        await message.add_reaction(emoji)
+
+
 def escape_markdown(text, language=''):
     prefix = f'```{language}\n'
     suffix = '```'
@@ -13,3 +46,91 @@ def escape_markdown(text, language=''):
         retval = '{}{}{}'.format(prefix, text, suffix)
 
     return retval
+
+
+def combine_code_blocks(parts, language='', limit=2000):
+    """Put each (title, text) in its own code block of a single message of at most limit characters
+
+    When they don't all fit, the longest texts are shortened, so that short ones are always shown whole.
+    """
+    prefix = f'```{language}\n'
+    suffix = '```'
+    ellipsis = '(...)'
+
+    texts = [text or '(no output)' for title, text in parts]
+    overhead = sum(len(title) + 1 + len(prefix) + len(suffix) for title, text in parts) + len(parts) - 1
+    available = max(0, limit - overhead)
+
+    # Share the space evenly, giving what the shortest texts don't need to the longer ones
+    allowed = [0] * len(texts)
+    for done, i in enumerate(sorted(range(len(texts)), key=lambda i: len(texts[i]))):
+        allowed[i] = min(len(texts[i]), available // (len(texts) - done))
+        available -= allowed[i]
+
+    blocks = []
+    for (title, _), text, length in zip(parts, texts, allowed):
+        if len(text) > length:
+            text = text[:max(0, length - len(ellipsis))] + ellipsis
+        blocks.append('{}\n{}{}{}'.format(title, prefix, text, suffix))
+
+    return '\n'.join(blocks)
+
+
+class StreamingReply:
+    """Reply whose contents are updated while the output of a running script arrives
+
+    Nothing is sent until the script has been running for `interval` seconds, so quick scripts still get a
+    single message. After that, the message is edited at most once every `interval` seconds.
+    """
+
+    def __init__(self, channel, language='', interval=1.5, delivery=None, message=None):
+        self.channel = channel
+        self.language = language
+        self.interval = interval
+        self.delivery = delivery  # OutputDelivery sending the final text, which is cut to one message otherwise
+
+        self.text = ''
+        self.message = message  # Reply to edit instead of sending a new one
+        self.update = None
+        self.finished = False
+        self.lock = asyncio.Lock()
+
+    def feed(self, chunk):
+        if len(self.text) < 2000:  # Anything after that can't be shown anyway
+            self.text += chunk
+
+        if self.update is None and not self.finished:
+            self.update = asyncio.ensure_future(self._update_later())
+
+    async def _show(self, text):
+        content = escape_markdown(text, language=self.language)
+        if self.message is None:
+            self.message = await send_message(self.channel, content)
+        else:
+            await edit_message(self.message, content=content)
+
+    async def _update_later(self):
+        await asyncio.sleep(self.interval)
+        async with self.lock:
+            self.update = None  # New output from now on schedules the next update
+            if self.finished:
+                return
+
+            try:
+                await self._show(self.text + '\n(running...)')
+            except Exception:
+                logger.exception('Could not update the partial output')
+
+    async def finish(self, text):
+        """Show the final text and return the message showing it"""
+        self.finished = True
+        async with self.lock:
+            if self.update:
+                self.update.cancel()
+
+            if self.delivery is None:
+                await self._show(text)
+            else:
+                self.message = await self.delivery.send(self.channel, text, self.language, self.message)
+
+        return self.message
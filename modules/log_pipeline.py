@@ -0,0 +1,99 @@
+"""Logging that never writes to disk from the event loop
+
+Records are put in a queue by the loggers, and formatted and written by a background thread. The log file is
+rotated by size or by time, and the rotated files can be gzipped. Lines are either plain text or JSON.
+"""
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+TEXT_FORMAT = '%(asctime)-15s:%(levelname)s:%(name)s: %(message)s'
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queue the records with their message and traceback already rendered, but not the rest of the line
+
+    The stock QueueHandler puts the traceback in the message, which JSON lines would then lose as a field.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None  # Tracebacks can't be pickled, and hold on to every frame
+        return record
+
+
+def _gzip_rotator(source, destination):
+    with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def create_file_handler(path, rotate_bytes=0, rotate_when=None, backup_count=5, compress=False):
+    """File handler rotating by time if rotate_when is set (see TimedRotatingFileHandler), by size otherwise"""
+    if rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate_when, backupCount=backup_count,
+                                                            encoding='utf-8', delay=True)
+    else:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=rotate_bytes, backupCount=backup_count,
+                                                       encoding='utf-8', delay=True)
+
+    if compress:
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+def setup_logging(path, level=logging.INFO, json_lines=False, rotate_bytes=0, rotate_when=None, backup_count=5,
+                  compress=False, file_logger='discord'):
+    """Send every log record through a queue to the console, and those of file_logger to the file too
+
+    Return the started QueueListener. Stop it before exiting, to write the records still in the queue.
+    """
+    formatter = JSONFormatter() if json_lines else logging.Formatter(TEXT_FORMAT)
+
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+
+    file_handler = create_file_handler(path, rotate_bytes, rotate_when, backup_count, compress)
+    file_handler.setFormatter(formatter)
+    file_handler.addFilter(logging.Filter(file_logger))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, console, file_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(LogQueueHandler(records))
+    root.setLevel(level)
+
+    listener.start()
+    return listener
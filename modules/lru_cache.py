@@ -0,0 +1,73 @@
+import sys
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache, bounded both by its number of entries and by their total size in bytes"""
+
+    def __init__(self, max_entries=1000, max_bytes=None, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # Would evict everything else and still not fit
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self.popitem()
+
+    def pop(self, key, default=None):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            return default
+
+        self.size -= size
+        return value
+
+    def popitem(self):
+        """Remove and return the least recently used (key, value)"""
+        key, (value, size) = self.entries.popitem(last=False)
+        self.size -= size
+        return key, value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,37 +1,284 @@
+import asyncio
+import json
+import logging
+import random
 import textwrap
+import time
+import urllib.parse
 
 import aiohttp
-import wikitextparser as wtp
-from bs4 import BeautifulSoup
 
+from modules import metrics
+from modules.lru_cache import LRUCache
 
-async def fetch_url(url):
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                text = await response.text()
-                return text
+logger = logging.getLogger('discord.' + __name__)
+
+WIKI_CACHE = metrics.counter('wiki_cache_total', 'Wiki pages requested, by how the HTTP cache answered (fresh, '
+                             'stale, or miss when the wiki had to be asked)', ['result'])
+WIKI_FETCH = metrics.histogram('wiki_fetch_seconds', 'Time taken to get a response from the wiki, retries '
+                               'included, by result (ok, not_modified or error)', ['result'])
+WIKI_PARSE = metrics.histogram('wiki_parse_seconds', 'Time taken to parse a Biki page, by stage (html for the '
+                               'edit page, wikitext for the RV template)', ['stage'])
+
+API_URL = 'https://community.bistudio.com/wikidata/api.php'
+API_BATCH_SIZE = 50  # Maximum number of titles in a single query, for regular users
+COMMANDS_CATEGORY = 'Category:Arma 3: Scripting Commands'
+
+HTTP_CONNECTION_LIMIT = 8
+HTTP_TIMEOUT = 30
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 1  # Seconds before the first retry, doubled after each attempt
+HTTP_CACHE_MAX_AGE = 60  # Seconds during which a cached response is used without asking the wiki
+HTTP_CACHE_STALE_WHILE_REVALIDATE = 24 * 3600  # Seconds during which a stale response is used while refreshing it
+
+
+class MediaWikiError(Exception):
+    pass
+
+
+class CachedResponse:
+    def __init__(self, body, etag, last_modified):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+
+_session = None
+_http_cache = LRUCache(max_entries=5000, max_bytes=64 * 1024 * 1024, sizeof=lambda response: len(response.body))
+_revalidations = {}  # cache key -> background task refreshing it
+
+
+def get_session():
+    """Long-lived session, so that connections to the wiki are kept alive and reused"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT),
+        )
+    return _session
+
+
+async def close_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+async def _request(key, url, params, cached):
+    """GET the url, conditionally if a cached response is available, retrying transient failures
+
+    The response is cached under key, unless key is None.
+    """
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+    start = time.perf_counter()
+    error = None
+    for attempt in range(HTTP_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+        try:
+            async with get_session().get(url, params=params, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    cached.fetched_at = time.monotonic()
+                    WIKI_FETCH.observe(time.perf_counter() - start, result='not_modified')
+                    return cached.body
+
+                if response.status == 200:
+                    body = await response.text()
+                    if key is not None:
+                        _http_cache.put(key, CachedResponse(body, response.headers.get('ETag'),
+                                                            response.headers.get('Last-Modified')))
+                    WIKI_FETCH.observe(time.perf_counter() - start, result='ok')
+                    return body
+
+                error = MediaWikiError('{} returned HTTP {}'.format(response.url, response.status))
+                if response.status < 500 and response.status != 429:
+                    break  # Asking again won't help
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = MediaWikiError('Could not fetch {}: {!r}'.format(url, e))
+
+    WIKI_FETCH.observe(time.perf_counter() - start, result='error')
+    if cached is not None:
+        logger.warning('%s, using a stale copy', error)
+        return cached.body
+
+    raise error
+
+
+def _revalidate_in_background(key, url, params, cached):
+    if key in _revalidations:
+        return
+
+    async def revalidate():
+        try:
+            await _request(key, url, params, cached)
+        except MediaWikiError as e:
+            logger.warning('%s', e)
+        finally:
+            del _revalidations[key]
+
+    _revalidations[key] = asyncio.ensure_future(revalidate())
+
+
+async def fetch_url(url, params=None, max_age=HTTP_CACHE_MAX_AGE,
+                    stale_while_revalidate=HTTP_CACHE_STALE_WHILE_REVALIDATE):
+    """Return the body of the page, raising MediaWikiError if it can't be fetched
+
+    Responses younger than max_age seconds are returned from the cache. Older ones are still returned right
+    away for stale_while_revalidate more seconds, while being refreshed in the background. Otherwise the
+    request uses the ETag and Last-Modified of the cached response, so that an unchanged page isn't sent again.
+    """
+    key = (url, tuple(sorted(params.items())) if params else ())
+    cached = _http_cache.get(key)
+
+    if cached is not None:
+        age = time.monotonic() - cached.fetched_at
+        if age < max_age:
+            WIKI_CACHE.inc(result='fresh')
+            return cached.body
+
+        if age < max_age + stale_while_revalidate:
+            WIKI_CACHE.inc(result='stale')
+            _revalidate_in_background(key, url, params, cached)
+            return cached.body
+
+    WIKI_CACHE.inc(result='miss')
+    return await _request(key, url, params, cached)
+
+
+async def fetch_api(**params):
+    """Run an API request, raising MediaWikiError if it fails
+
+    The API is used to keep track of changes, so its responses are never cached: a stale copy would make an
+    outage look like nothing has changed.
+    """
+    params.update(format='json', formatversion='2')
+    body = await _request(None, API_URL, params, None)
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        raise MediaWikiError('Invalid response from the API: {!r}'.format(e))
+
+    if 'error' in data:
+        raise MediaWikiError('API error: {}'.format(data['error'].get('info', data['error'])))
+    return data
+
+
+async def query_all(**params):
+    """Run an API query, following its continuations until every result has been returned"""
+    continuation = {}
+    while True:
+        data = await fetch_api(action='query', **params, **continuation)
+        if 'query' in data:
+            yield data['query']
+
+        if 'continue' not in data:
+            break
+        continuation = data['continue']
+
+
+def get_url_part(title):
+    """Return the path of a page, the way MediaWiki writes it in its links: /wiki/Page_title"""
+    return '/wiki/' + urllib.parse.quote(title.replace(' ', '_'), safe=';@$!*(),/~:')
+
+
+def _pages_by_requested_title(data, titles):
+    """Map the pages of a query to the titles they were requested with, before MediaWiki normalized them"""
+    requested = {title: title for title in titles}
+    for normalized in data['query'].get('normalized', []):
+        requested[normalized['to']] = normalized['from']
+
+    return {requested.get(page['title'], page['title']): page
+            for page in data['query'].get('pages', []) if 'missing' not in page}
+
+
+async def get_revisions(titles):
+    """Return {title: latest revision id} of up to API_BATCH_SIZE pages"""
+    data = await fetch_api(action='query', prop='info', titles='|'.join(titles))
+    return {title: page['lastrevid'] for title, page in _pages_by_requested_title(data, titles).items()}
+
+
+async def get_pages(titles):
+    """Return {title: (revision id, wikitext)} of up to API_BATCH_SIZE pages"""
+    data = await fetch_api(action='query', prop='revisions', rvprop='ids|content', rvslots='main',
+                           titles='|'.join(titles))
+
+    pages = {}
+    for title, page in _pages_by_requested_title(data, titles).items():
+        if page.get('revisions'):
+            revision = page['revisions'][0]
+            pages[title] = (revision['revid'], revision['slots']['main']['content'])
+    return pages
 
 
 async def get_list():
-    contents = await fetch_url('https://community.bistudio.com/wiki/Category:Arma_3:_Scripting_Commands')
-    soup = BeautifulSoup(contents, 'html.parser')
-    links_html = soup.find(id='mw-pages').find('div', class_='mw-category-group').ul.find_all('a')
-    links = {link['title']: link['href'] for link in links_html}
+    """Return {title: url part} of every command"""
+    links = {}
+    async for query in query_all(list='categorymembers', cmtitle=COMMANDS_CATEGORY, cmnamespace=0, cmprop='title',
+                                 cmlimit='max'):
+        for member in query['categorymembers']:
+            links[member['title']] = get_url_part(member['title'])
+
     return links
 
 
+async def get_recent_changes(since):
+    """Return the titles of the pages created, edited, moved or deleted since the (ISO 8601) timestamp"""
+    titles = set()
+    async for query in query_all(list='recentchanges', rcstart=since, rcdir='newer', rcnamespace=0,
+                                 rctype='edit|new|log', rcprop='title|loginfo', rclimit='max'):
+        for change in query['recentchanges']:
+            titles.add(change['title'])
+
+            # Moved pages are also known by their new title
+            target = change.get('logparams', {}).get('target_title')
+            if target:
+                titles.add(target)
+
+    return titles
+
+
+async def get_category_members(titles, category=COMMANDS_CATEGORY):
+    """Return which ones of up to API_BATCH_SIZE titles belong to the category"""
+    data = await fetch_api(action='query', prop='categories', clcategories=category, cllimit='max',
+                           titles='|'.join(titles))
+    return {title for title, page in _pages_by_requested_title(data, titles).items() if page.get('categories')}
+
+
 async def get_page(command_url_part):
     # https://community.bistudio.com/wiki?title=a_%26%26_b&action=edit
     url = 'https://community.bistudio.com/wiki?title={}&action=edit'.format(command_url_part)
     contents = await fetch_url(url)
-    soup = BeautifulSoup(contents, 'html.parser')
-    mediawiki = soup.find(id='wpTextbox1').text
+    from bs4 import BeautifulSoup  # Slow to import, and rarely needed since pages come from the local index
 
-    return mediawiki
+    with WIKI_PARSE.time(stage='html'):
+        soup = BeautifulSoup(contents, 'html.parser')
+        textarea = soup.find(id='wpTextbox1')
+    if textarea is None:
+        raise MediaWikiError('No wikitext found on {}'.format(url))
+
+    return textarea.text
 
 
 class SQFCommand:
+    __slots__ = (
+        # Meta
+        'type', 'display_type',
+        # Primary parameters
+        'game', 'version', 'arg', 'eff', 'server_exec', 'description', 'command_groups', 'syntax', 'parameters',
+        'return_value', 'examples', 'see_also',
+        # Secondary parameters
+        'multiplayer', 'problems', 'alt_game', 'alt_version', 'alt_syntax', 'alt_parameters', 'alt_return_value',
+    )
+
     def _get_plain_text(self, arg):
         if arg is None:
             return ''
@@ -58,10 +305,10 @@ class SQFCommand:
         plain = plain.strip()
         return plain
 
-    def _parse_array(self, prefix, range_start, range_stop):
+    def _parse_array(self, mw_arguments, prefix, range_start, range_stop):
         array = []
         for i in range(range_start, range_stop):
-            mw_argument = self._mw_template.get_arg(f'{prefix}{i}')
+            mw_argument = mw_arguments.get(f'{prefix}{i}')
 
             if mw_argument:
                 argument = self._get_plain_text(mw_argument)
@@ -69,9 +316,9 @@ class SQFCommand:
 
         return array
 
-    def _parse_argument(self, *arg_names, default=''):
+    def _parse_argument(self, mw_arguments, *arg_names, default=''):
         for arg_name in arg_names:
-            mw_arg = self._mw_template.get_arg(arg_name)
+            mw_arg = mw_arguments.get(arg_name)
             if mw_arg:
                 return self._get_plain_text(mw_arg)
 
@@ -82,47 +329,57 @@ class SQFCommand:
         if not template.name == 'RV':
             raise ValueError(f'Tried to initialize with a bad template of: "{template.name}", expected "RV"')
 
-        self._mw_template = template
+        # Index the arguments in a single pass. Like in MediaWiki (and template.get_arg), the last one wins
+        args = {arg.name.strip(): arg for arg in template.arguments}
 
         # Meta
-        self.type = self._parse_argument('type')
-        self.display_type = self._parse_argument('displayTitle', default=page_name)
+        self.type = self._parse_argument(args, 'type')
+        self.display_type = self._parse_argument(args, 'displayTitle', default=page_name)
 
         # Primary parameters
-        self.game = self._parse_argument('game1', '1')
-        self.version = self._parse_argument('version1', '2', default='Unknown')
-        self.arg = self._parse_argument('arg')
-        self.eff = self._parse_argument('arg')
-        self.server_exec = self._parse_argument('serverExec')
-        self.description = self._parse_argument('descr', '3', default='Description not found!')
-        self.command_groups = self._parse_array('gr', 1, 6)
-        self.syntax = self._parse_argument('s1', '4', default=page_name)
-        self.parameters = self._parse_array('p', 1, 21)
-        self.return_value = self._parse_argument('r1', '5', default='Nothing')
-        self.examples = self._parse_array('x', 1, 11)
-        self.see_also = self._parse_argument('seealso', '6', default='See also needed')
+        self.game = self._parse_argument(args, 'game1', '1')
+        self.version = self._parse_argument(args, 'version1', '2', default='Unknown')
+        self.arg = self._parse_argument(args, 'arg')
+        self.eff = self._parse_argument(args, 'eff')
+        self.server_exec = self._parse_argument(args, 'serverExec')
+        self.description = self._parse_argument(args, 'descr', '3', default='Description not found!')
+        self.command_groups = self._parse_array(args, 'gr', 1, 6)
+        self.syntax = self._parse_argument(args, 's1', '4', default=page_name)
+        self.parameters = self._parse_array(args, 'p', 1, 21)
+        self.return_value = self._parse_argument(args, 'r1', '5', default='Nothing')
+        self.examples = self._parse_array(args, 'x', 1, 11)
+        self.see_also = self._parse_argument(args, 'seealso', '6', default='See also needed')
 
         # Secondary parameters
-        self.multiplayer = self._parse_argument('mp')
-        self.problems = self._parse_argument('pr')
+        self.multiplayer = self._parse_argument(args, 'mp')
+        self.problems = self._parse_argument(args, 'pr')
 
-        self.alt_game = self._parse_array('game', 2, 6)
-        self.alt_version = self._parse_array('version', 2, 6)
-        self.alt_syntax = self._parse_array('s', 2, 7)
+        self.alt_game = self._parse_array(args, 'game', 2, 6)
+        self.alt_version = self._parse_array(args, 'version', 2, 6)
+        self.alt_syntax = self._parse_array(args, 's', 2, 7)
         self.alt_parameters = [
-            self._parse_array('p', 21, 41),
-            self._parse_array('p', 41, 61),
-            self._parse_array('p', 61, 81),
-            self._parse_array('p', 81, 101),
-            self._parse_array('p', 101, 121),
+            self._parse_array(args, 'p', 21, 41),
+            self._parse_array(args, 'p', 41, 61),
+            self._parse_array(args, 'p', 61, 81),
+            self._parse_array(args, 'p', 81, 101),
+            self._parse_array(args, 'p', 101, 121),
         ]
-        self.alt_return_value = self._parse_array('r', 2, 7)
+        self.alt_return_value = self._parse_array(args, 'r', 2, 7)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, fields):
+        """Recreate a command from the fields returned by to_dict(), without parsing its page again"""
+        sqf_command = cls.__new__(cls)
+        for key in cls.__slots__:
+            setattr(sqf_command, key, fields[key])
+        return sqf_command
 
     def __str__(self):
         strings = []
-        for key, val in self.__dict__.items():
-            if key.startswith('_'):
-                continue
+        for key, val in self.to_dict().items():
             if not isinstance(val, list) or not val:  # Empty lists treat as regular values
                 strings.append(f'{key}: {val}')
             else:
@@ -134,6 +391,14 @@ class SQFCommand:
 
 
 def parse_mediawiki_textarea(textarea):
+    import wikitextparser as wtp  # Slow to import, and only needed once a page has to be parsed
+
     parsed = wtp.parse(textarea)
     template = parsed.templates[0]
     return template
+
+
+def parse_sqf_command(name, wikitext):
+    """Parse the wikitext of the page of a command into an SQFCommand"""
+    with WIKI_PARSE.time(stage='wikitext'):
+        return SQFCommand(name, parse_mediawiki_textarea(wikitext))
@@ -0,0 +1,181 @@
+"""Counters and histograms of what the bots are doing, exported in the Prometheus text format
+
+Metrics are declared once, at module level, next to the code that updates them:
+
+    CALLS = metrics.counter('sqfvm_calls_total', 'SQF-VM calls', ['type'])
+    CALLS.inc(type='sqf')
+"""
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (64, 256, 1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024)
+
+_registry = {}  # name -> metric
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}  # tuple of label values -> value
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError('{} expects the labels {}, got {}'.format(self.name, self.label_names, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """Yield (suffix, label pairs, value) for every sample of the metric"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, pairs, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(pairs), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield '', list(zip(self.label_names, key)), value
+
+    def summary(self):
+        with self.lock:
+            return {key: value for key, value in sorted(self.values.items())}
+
+
+class HistogramValue:
+    def __init__(self, bucket_count):
+        self.buckets = [0] * bucket_count  # Not cumulative, the last one counts what's above every bound
+        self.count = 0
+        self.sum = 0
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.bounds = tuple(sorted(buckets))
+
+    def observe(self, amount, **labels):
+        key = self._key(labels)
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                value = self.values[key] = HistogramValue(len(self.bounds) + 1)
+            value.buckets[bisect.bisect_left(self.bounds, amount)] += 1
+            value.count += 1
+            value.sum += amount
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the block took, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(value.buckets), value.count, value.sum) for key, value in self.values.items())
+
+        for key, buckets, count, total in items:
+            pairs = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket in zip(self.bounds + (math.inf,), buckets):
+                cumulative += bucket
+                yield '_bucket', pairs + [('le', _format_value(bound))], cumulative
+            yield '_sum', pairs, total
+            yield '_count', pairs, count
+
+    def quantile(self, key, fraction):
+        """Estimate a quantile from the buckets, the way Prometheus' histogram_quantile does"""
+        with self.lock:
+            value = self.values[key]
+            buckets = list(value.buckets)
+            count = value.count
+
+        rank = fraction * count
+        cumulative = 0
+        for i, bucket in enumerate(buckets):
+            if cumulative + bucket >= rank and bucket:
+                if i == len(self.bounds):
+                    return self.bounds[-1]  # Above the highest bound, nothing more precise can be said
+                lower = self.bounds[i - 1] if i else 0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / bucket
+            cumulative += bucket
+        return 0
+
+    def summary(self):
+        with self.lock:
+            keys = sorted(self.values)
+            totals = {key: (self.values[key].count, self.values[key].sum) for key in keys}
+
+        return {key: {'count': count, 'mean': total / count if count else 0,
+                      'p50': self.quantile(key, 0.5), 'p95': self.quantile(key, 0.95)}
+                for key, (count, total) in totals.items()}
+
+
+def _register(metric):
+    existing = _registry.get(metric.name)
+    if existing is None:
+        _registry[metric.name] = metric
+        return metric
+
+    # A reloaded module declares its metrics again, keep counting in the same ones
+    if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+        raise ValueError('A different metric named {} already exists'.format(metric.name))
+    return existing
+
+
+def counter(name, documentation, labels=()):
+    return _register(Counter(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, labels, buckets))
+
+
+def get_metrics():
+    return list(_registry.values())
+
+
+def render():
+    """All the metrics in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in _registry.values()) + '\n'
@@ -0,0 +1,114 @@
+"""Sending outputs of any size to Discord, without cutting them
+
+- Short outputs are sent inline, in a code block.
+- Medium ones are split in pages, browsed with reactions. The output is kept in memory and each page is only
+  rendered when it's shown.
+- Large ones are sent as a file attachment, optionally gzipped.
+"""
+import gzip
+import io
+import logging
+
+import discord
+
+from modules.discord_utils import add_reaction, delete_message, edit_message, escape_markdown, send_message
+from modules.lru_cache import LRUCache
+
+logger = logging.getLogger('discord.' + __name__)
+
+PREVIOUS_PAGE = '\N{BLACK LEFT-POINTING TRIANGLE}'
+NEXT_PAGE = '\N{BLACK RIGHT-POINTING TRIANGLE}'
+
+
+class PagedOutput:
+    def __init__(self, text, language, page_size):
+        self.message = None
+        self.text = text
+        self.language = language
+        self.page = 0
+
+        # Only the page boundaries are computed in advance, preferably at line breaks
+        self.offsets = []
+        start = 0
+        while start < len(text):
+            end = min(start + page_size, len(text))
+            if end < len(text):
+                line_break = text.rfind('\n', start, end)
+                if line_break > start:
+                    end = line_break + 1
+            self.offsets.append((start, end))
+            start = end
+
+    def render(self, page):
+        start, end = self.offsets[page]
+        return '```{}\n{}```Page {}/{}'.format(self.language, self.text[start:end], page + 1, len(self.offsets))
+
+
+class OutputDelivery:
+    def __init__(self, page_size=1900, max_pages=10, max_paged=1000, memory_budget=8 * 1024 * 1024,
+                 gzip_attachments=False):
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.gzip_attachments = gzip_attachments
+
+        # message id -> PagedOutput. The least recently browsed outputs are dropped first, and can't be paged anymore
+        self.paged = LRUCache(max_entries=max_paged, max_bytes=memory_budget, sizeof=lambda paged: len(paged.text))
+
+    async def replace(self, channel, message, **kwargs):
+        """Edit the message if given and possible, otherwise send a new one instead of it. Return the message"""
+        if message is None:
+            return await send_message(channel, **kwargs)
+
+        self.paged.pop(message.id)  # It's getting a new output
+        try:
+            # Attachments can't be added to, or removed from, a message that was already sent
+            if 'file' not in kwargs and not message.attachments:
+                await edit_message(message, **kwargs)
+                return message
+
+            await delete_message(message)
+        except discord.NotFound:
+            pass  # Deleted by someone else
+
+        return await send_message(channel, **kwargs)
+
+    async def send(self, channel, text, language='', message=None):
+        """Send the text in the channel, or show it in the given message. Return the message showing it"""
+        if len('```{}\n{}```'.format(language, text)) <= 2000:
+            return await self.replace(channel, message, content=escape_markdown(text, language))
+
+        if len(text) <= self.page_size * self.max_pages:
+            paged = PagedOutput(text, language, self.page_size)
+            message = paged.message = await self.replace(channel, message, content=paged.render(0))
+            self.paged.put(message.id, paged)
+            await add_reaction(message, PREVIOUS_PAGE)
+            await add_reaction(message, NEXT_PAGE)
+            return message
+
+        data = text.encode('utf-8')
+        filename = 'output.txt'
+        if self.gzip_attachments:
+            data = gzip.compress(data)
+            filename += '.gz'
+        file = discord.File(io.BytesIO(data), filename=filename)
+        return await self.replace(channel, message, content='The output is too long, it is attached', file=file)
+
+    async def turn_page(self, message_id, emoji):
+        """Show the previous or next page of a paginated output, depending on the reaction"""
+        paged = self.paged.get(message_id)
+        if paged is None:
+            return
+
+        if emoji == NEXT_PAGE:
+            page = min(paged.page + 1, len(paged.offsets) - 1)
+        elif emoji == PREVIOUS_PAGE:
+            page = max(paged.page - 1, 0)
+        else:
+            return
+
+        if page != paged.page:
+            paged.page = page
+            try:
+                await edit_message(paged.message, content=paged.render(page))
+            except discord.HTTPException:
+                logger.warning('Could not show page %d of message %d', page + 1, message_id, exc_info=True)
@@ -0,0 +1,186 @@
+"""Fair scheduling of the scripts sent to SQF-VM
+
+Scripts waiting for a free worker are queued per channel, and inside each channel per user. Channels take turns,
+and so do the users of each channel, so someone sending many long scripts only slows themselves down.
+"""
+import asyncio
+import collections
+import time
+
+from modules import metrics
+
+SCHEDULER_WAIT = metrics.histogram('scheduler_wait_seconds', 'Time scripts waited in the fair queue before running')
+SCHEDULER_REJECTED = metrics.counter('scheduler_rejected_total', 'Scripts refused because a queue was full',
+                                     ['reason'])
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, scheduler, user, channel):
+        self.scheduler = scheduler
+        self.user = user
+        self.channel = channel
+        self.started = asyncio.get_event_loop().create_future()
+        self.queued_at = time.perf_counter()
+        self.entered = False
+        self.done = False
+
+    def position(self):
+        """1-based position of the job in the queue, or 0 once it has started"""
+        return self.scheduler.position(self)
+
+    def cancel(self):
+        """Give up a job that was never entered, freeing its slot or its place in the queue. Safe to call twice"""
+        if not self.entered and not self.done:
+            self.done = True
+            self.scheduler.cancel(self)
+
+    async def __aenter__(self):
+        try:
+            await asyncio.shield(self.started)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        self.entered = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.done = True
+        self.scheduler.release()
+
+
+class FairScheduler:
+    def __init__(self, slots, max_queued=50, max_queued_per_user=3, max_queued_per_channel=10):
+        self.slots = slots
+        self.running = 0
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queued_per_channel = max_queued_per_channel
+
+        # channel -> user -> jobs. Both levels are kept in the order of their next turn
+        self.queues = collections.OrderedDict()
+        self.queued = 0
+        self.queued_per_user = collections.Counter()
+
+    def submit(self, user, channel):
+        """Queue a job, raising SchedulerFull if there's no room for it. Use it with `async with job:`"""
+        return self.submit_many(user, channel, 1)[0]
+
+    def submit_many(self, user, channel, count):
+        """Queue count jobs at once: either all of them fit, or SchedulerFull is raised"""
+        # Jobs that can start right away never wait in a queue
+        waiting = max(0, count - max(0, self.slots - self.running - self.queued))
+
+        if self.queued + waiting > self.max_queued:
+            SCHEDULER_REJECTED.inc(reason='total')
+            raise SchedulerFull('SQF-VM is too busy right now, try again in a moment')
+
+        if self.queued_per_user[user] + waiting > self.max_queued_per_user:
+            SCHEDULER_REJECTED.inc(reason='user')
+            raise SchedulerFull('You have too many scripts waiting, wait for them to finish')
+
+        users = self.queues.get(channel)
+        channel_queued = sum(len(jobs) for jobs in users.values()) if users else 0
+        if channel_queued + waiting > self.max_queued_per_channel:
+            SCHEDULER_REJECTED.inc(reason='channel')
+            raise SchedulerFull('Too many scripts are waiting in this channel, try again in a moment')
+
+        if users is None:
+            users = self.queues[channel] = collections.OrderedDict()
+        jobs = [Job(self, user, channel) for _ in range(count)]
+        users.setdefault(user, collections.deque()).extend(jobs)
+        self.queued += count
+        self.queued_per_user[user] += count
+
+        self._dispatch()
+        return jobs
+
+    def _next_job(self):
+        channel, users = next(iter(self.queues.items()))
+        user, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+
+        # Their turn is over, go to the back of the line
+        if jobs:
+            users.move_to_end(user)
+        else:
+            del users[user]
+        if users:
+            self.queues.move_to_end(channel)
+        else:
+            del self.queues[channel]
+
+        self.queued -= 1
+        self.queued_per_user[user] -= 1
+        if not self.queued_per_user[user]:
+            del self.queued_per_user[user]
+
+        return job
+
+    def _dispatch(self):
+        while self.running < self.slots and self.queued:
+            job = self._next_job()
+            if job.started.done():
+                continue  # Cancelled while waiting
+
+            self.running += 1
+            SCHEDULER_WAIT.observe(time.perf_counter() - job.queued_at)
+            job.started.set_result(None)
+
+    def resize(self, slots):
+        """Change how many jobs can run at once. Running jobs are never interrupted"""
+        self.slots = slots
+        self._dispatch()
+
+    def release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def cancel(self, job):
+        if job.started.done() and not job.started.cancelled():
+            self.release()  # It had already been given a slot
+            return
+
+        job.started.cancel()
+        users = self.queues.get(job.channel)
+        jobs = users.get(job.user) if users else None
+        if jobs and job in jobs:
+            jobs.remove(job)
+            self.queued -= 1
+            self.queued_per_user[job.user] -= 1
+            if not self.queued_per_user[job.user]:
+                del self.queued_per_user[job.user]
+            if not jobs:
+                del users[job.user]
+            if not users:
+                del self.queues[job.channel]
+
+    def position(self, job):
+        if job.started.done():
+            return 0
+
+        # Replay the turns on a copy of the queues
+        queues = collections.OrderedDict(
+            (channel, collections.OrderedDict((user, list(jobs)) for user, jobs in users.items()))
+            for channel, users in self.queues.items())
+        position = 0
+        while queues:
+            channel, users = next(iter(queues.items()))
+            user, jobs = next(iter(users.items()))
+            position += 1
+            if jobs.pop(0) is job:
+                return position
+
+            if jobs:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if users:
+                queues.move_to_end(channel)
+            else:
+                del queues[channel]
+
+        return 0
@@ -2,6 +2,7 @@
 # Bots settings
 ################################################################################
 
+import logging
 import os
 
 # Copy this whole structure and replace with your values, in local.py
@@ -16,4 +17,67 @@ ADMINS = [
 
 VMPATH = os.path.join('..', 'SQFvm')
 SQFVM_LIB_PATH = os.path.join(VMPATH, 'libcsqfvm.so')
+# Rebuilds happen in a separate directory and each build is then copied under a versioned name, so that the
+# library in use is never overwritten
+SQFVM_BUILD_PATH = os.path.join(VMPATH, 'build-bot')
+SQFVM_BUILD_OUTPUT = os.path.join(SQFVM_BUILD_PATH, 'libcsqfvm.so')
+SQFVM_BUILDS_PATH = os.path.join(VMPATH, 'builds')
+SQFVM_KEEP_BUILDS = 3
+SQFVM_WORKERS = os.cpu_count() or 1  # Number of worker processes running SQF-VM code in parallel
+SQFVM_WARM_INSTANCES = 1  # SQF-VM instances created in advance by each worker process
+# How many calls an instance serves before being recycled. SQF-VM can't reset an instance, so the global variables
+# set by a script would be visible to the next scripts run by the same instance, from any user. Keep 1 (a fresh,
+# pre-created instance for every call) unless the scripts run can be trusted
+SQFVM_INSTANCE_MAX_CALLS = 1
+SQFVM_MAX_OUTPUT_BYTES = 64 * 1024  # Output past this is dropped instead of being kept in memory
+# Seconds a script may run past its SQF-VM timeout before its worker process is killed
+SQFVM_DEADLINE_GRACE = 5
+# Run the scripts on execution nodes (python sqfvm_node.py) instead of worker processes of the bot. Calls are
+# spread over the nodes that pass their health checks: ['tcp://10.0.0.2:7640', 'unix:///run/sqfvm-node.sock']
+SQFVM_NODES = []
+SQFVM_NODE_LISTEN = 'tcp://127.0.0.1:7640'  # Where sqfvm_node.py listens, on the nodes
+SQFVM_NODE_TOKEN = None  # Shared secret checked by the nodes. Set it if they listen on a network
+SQFVM_NODE_HEALTH_INTERVAL = 5  # Seconds
+# Config files (config.cpp contents) loaded into every SQF-VM instance, for scripts using configFile.
+# They're parsed when the instances are created, and loaded again when they change on disk
+SQFVM_CONFIG_FILES = []  # [os.path.join(VMPATH, 'config.cpp')]
+# Deterministic call types, whose results are cached and shared by identical calls running at the same time:
+# the text transforms 'p'reprocess and sqf2sqc ('1'). 'a'ssembly and 's'qf execute code, whose output may change
+# from one run to the next (random, diag_tickTime...), so only add them if that's acceptable
+SQFVM_CACHED_TYPES = 'p1'
+SQFVM_CACHE_MAX_ENTRIES = 1000
+SQFVM_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Scripts waiting for a free worker. Past these limits, new scripts are refused instead of queued
+SQFVM_QUEUE_MAX = 50
+SQFVM_QUEUE_MAX_PER_USER = 5
+SQFVM_QUEUE_MAX_PER_CHANNEL = 10
+SQFVM_MAX_CODE_BLOCKS = 5  # Fenced blocks of a single message that are run, at the same time
+# Outputs too long for a single message are split in pages, browsed with reactions, up to OUTPUT_MAX_PAGES pages.
+# Longer ones are attached as a file
+OUTPUT_MAX_PAGES = 10
+OUTPUT_PAGES_MAX_BYTES = 8 * 1024 * 1024  # Memory for the outputs that can be paged, the oldest are dropped first
+OUTPUT_GZIP_ATTACHMENTS = False
+SQFVM_TRACKED_REPLIES = 500  # Latest replies updated when the message they answer is edited
 BUILD_ENV = {}  # {'CC': 'gcc-8', 'CXX':'g++-8'}
+BUILD_USE_CCACHE = True  # Only if ccache is installed
+
+BIKI_DB_PATH = 'biki.sqlite3'  # Local index of the Biki pages of all the commands
+BIKI_CRAWL_CONCURRENCY = 4  # Requests made at the same time when updating the index
+# In between, only the recent changes of the wiki are used to update the index
+BIKI_FULL_SYNC_INTERVAL = 24 * 3600
+BIKI_PARSED_CACHE_SIZE = 500  # Commands kept in memory, already parsed
+BIKI_EMBED_CACHE_SIZE = 500  # Embeds kept in memory, ready to be sent
+
+# Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics. Set the port to None to disable it
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464
+
+# Logs are written by a background thread. The file only gets the logs of the bots, and is rotated when it
+# reaches LOG_ROTATE_BYTES, or at LOG_ROTATE_WHEN if set ('midnight', 'h', 'w0'... see TimedRotatingFileHandler)
+LOG_FILE = 'discord.log'
+LOG_LEVEL = logging.INFO
+LOG_JSON = False  # One JSON object per line instead of plain text
+LOG_ROTATE_BYTES = 10 * 1024 * 1024
+LOG_ROTATE_WHEN = None
+LOG_BACKUP_COUNT = 5
+LOG_COMPRESS = True  # Gzip the rotated files
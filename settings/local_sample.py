@@ -14,4 +14,5 @@ SQF_BOT = {
 
 # import platform
 # if platform.system() == 'Windows':
-#     SQFVM_LIB_PATH = os.path.join(VMPATH, 'Debug', 'libcsqfvm.dll')
+#     SQFVM_LIB_PATH = os.path.join(VMPATH, 'libcsqfvm.dll')
+#     SQFVM_BUILD_OUTPUT = os.path.join(SQFVM_BUILD_PATH, 'Debug', 'libcsqfvm.dll')
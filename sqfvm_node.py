@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""SQF-VM execution node
+
+Runs scripts sent by bots on other machines (see SQFVM_NODES), in a pool of worker processes configured with
+the SQFVM_* settings of this machine.
+
+Usage: python sqfvm_node.py [--listen tcp://0.0.0.0:7640 | --listen unix:///run/sqfvm-node.sock]
+"""
+import argparse
+import asyncio
+import hmac
+import logging
+import os
+
+import settings
+from modules.log_pipeline import setup_logging
+from sqfvm_wrapper import (SQFVMWrapper, WorkerCrashed, parse_node_address, read_message, start_node_server,
+                           write_message)
+
+logger = logging.getLogger('discord.' + __name__)
+
+CONFIG_CHECK_INTERVAL = 60  # Seconds
+
+
+class SQFVMNode:
+    def __init__(self, wrapper, token=None):
+        self.wrapper = wrapper
+        self.token = token
+        self.running = 0
+
+    def check_token(self, hello):
+        if hello.get('op') != 'hello':
+            return False
+        if self.token is None:
+            return True
+        return hmac.compare_digest(str(hello.get('token')), self.token)
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or 'unix socket'
+        calls = {}  # request id -> task running the call
+        try:
+            if not self.check_token(await read_message(reader)):
+                logger.warning('Refused a connection from %s: wrong token', peer)
+                return
+
+            logger.info('Connection from %s', peer)
+            while True:
+                message = await read_message(reader)
+                op = message['op']
+                if op == 'health':
+                    write_message(writer, {'id': message['id'], 'kind': 'health', 'workers': self.wrapper.workers,
+                                           'running': self.running, 'build_id': self.wrapper.build_id,
+                                           'config_id': self.wrapper.config_id})
+                elif op == 'call':
+                    task = asyncio.ensure_future(self.call(writer, message))
+                    calls[message['id']] = task
+                    task.add_done_callback(lambda _, request_id=message['id']: calls.pop(request_id, None))
+                elif op == 'cancel' and message['id'] in calls:
+                    calls[message['id']].cancel()
+        except (EOFError, OSError, ValueError, KeyError) as e:
+            logger.info('Connection from %s closed: %r', peer, e)
+        finally:
+            # Nobody is waiting for these results anymore
+            for task in calls.values():
+                task.cancel()
+            writer.close()
+
+    async def call(self, writer, message):
+        request_id = message['id']
+
+        def on_output(chunk):
+            write_message(writer, {'id': request_id, 'kind': 'output', 'chunk': chunk})
+
+        deadline = message.get('deadline') or message['timeout'] + self.wrapper.deadline_grace
+        self.running += 1
+        try:
+            retval, output, queue_wait, execution = await self.wrapper.pool.run(
+                message['code'], message['timeout'], message['type'], on_output if message['stream'] else None,
+                deadline=deadline)
+        except asyncio.TimeoutError:
+            logger.warning('SQF-VM call still running after its deadline, its worker was killed')
+            reply = {'kind': 'error', 'error': 'deadline'}
+        except WorkerCrashed as e:
+            logger.error('SQF-VM worker process died: %s', e)
+            reply = {'kind': 'error', 'error': 'crashed', 'message': str(e)}
+        else:
+            # The time waited for a worker here is part of the time waited by the bot
+            reply = {'kind': 'result', 'retval': retval, 'output': output, 'execution': execution}
+        finally:
+            self.running -= 1
+
+        reply['id'] = request_id
+        write_message(writer, reply)
+
+    async def reload_changed_configs(self):
+        while True:
+            await asyncio.sleep(CONFIG_CHECK_INTERVAL)
+            if self.wrapper.configs_changed():
+                logger.info('SQF-VM config files changed, reloading them')
+                self.wrapper.reload_configs()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listen', default=settings.SQFVM_NODE_LISTEN,
+                        help='tcp://host:port or unix:///path (default: {})'.format(settings.SQFVM_NODE_LISTEN))
+    parser.add_argument('--log-file', default='sqfvm_node.log')
+    args = parser.parse_args()
+
+    log_listener = setup_logging(args.log_file, level=settings.LOG_LEVEL, json_lines=settings.LOG_JSON,
+                                 rotate_bytes=settings.LOG_ROTATE_BYTES, rotate_when=settings.LOG_ROTATE_WHEN,
+                                 backup_count=settings.LOG_BACKUP_COUNT, compress=settings.LOG_COMPRESS)
+
+    kind, target = parse_node_address(args.listen)
+    if kind == 'unix' and os.path.exists(target):
+        os.remove(target)  # Left by a previous run
+
+    wrapper = SQFVMWrapper(settings.SQFVM_LIB_PATH,
+                           workers=settings.SQFVM_WORKERS,
+                           max_instance_calls=settings.SQFVM_INSTANCE_MAX_CALLS,
+                           warm_instances=settings.SQFVM_WARM_INSTANCES,
+                           max_output_bytes=settings.SQFVM_MAX_OUTPUT_BYTES,
+                           config_files=settings.SQFVM_CONFIG_FILES,
+                           deadline_grace=settings.SQFVM_DEADLINE_GRACE)
+    wrapper.load()
+    node = SQFVMNode(wrapper, token=settings.SQFVM_NODE_TOKEN)
+
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(start_node_server(args.listen, node.handle_connection))
+    config_task = loop.create_task(node.reload_changed_configs())
+    logger.info('SQF-VM node listening on %s, with %d workers', args.listen, wrapper.workers)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        config_task.cancel()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        wrapper.unload()
+        loop.close()
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
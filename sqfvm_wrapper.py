@@ -1,9 +1,38 @@
 import _ctypes
 import asyncio
+import collections
 import ctypes
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
 import platform
+import random
+import threading
+import time
+import urllib.parse
 from ctypes import CDLL
 
+from modules import metrics
+from modules.lru_cache import LRUCache
+
+logger = logging.getLogger('discord.' + __name__)
+
+SQFVM_CALLS = metrics.counter('sqfvm_calls_total', 'SQF-VM calls run by a worker, by call type and SQF-VM '
+                              'error code (or no_instance/crashed/deadline)', ['type', 'code'])
+SQFVM_CACHE_HITS = metrics.counter('sqfvm_cache_hits_total', 'SQF-VM calls answered from the results cache',
+                                   ['type'])
+SQFVM_COALESCED = metrics.counter('sqfvm_coalesced_total', 'SQF-VM calls that shared the execution of an identical '
+                                  'call already running', ['type'])
+SQFVM_QUEUE_WAIT = metrics.histogram('sqfvm_queue_wait_seconds', 'Time SQF-VM calls waited for a free worker',
+                                     ['type'])
+SQFVM_EXECUTION = metrics.histogram('sqfvm_execution_seconds', 'Time SQF-VM calls spent running in a worker',
+                                    ['type', 'code'])
+SQFVM_OUTPUT = metrics.histogram('sqfvm_output_bytes', 'Size of the output of SQF-VM calls', ['type'],
+                                 buckets=metrics.BYTES_BUCKETS)
+
 
 def unload_dll(dll):
     if platform.system() == 'Windows':
@@ -12,25 +41,123 @@ def unload_dll(dll):
         _ctypes.dlclose(dll._handle)
 
 
-class SQFVMWrapper:
-    def __init__(self, path):
+# typedef void(*sqfvm_log_callback)(void* user_data, void* call_data, int32_t severity, const char* message,
+#                                   uint32_t length);
+sqfvm_log_callback = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int32, ctypes.c_char_p,
+                                      ctypes.c_uint32)
+
+
+class OutputBuffer:
+    """Collects the log lines of a call up to max_bytes, optionally passing them on in chunks while it runs
+
+    If given, on_truncated is called with the buffer once max_bytes is reached.
+    """
+
+    def __init__(self, max_bytes=None, on_output=None, chunk_bytes=1024, chunk_interval=0.5, on_truncated=None):
+        self.max_bytes = max_bytes
+        self.lines = []
+        self.size = 0
+        self.truncated = False
+        self.on_truncated = on_truncated
+
+        self.on_output = on_output
+        self.chunk_bytes = chunk_bytes
+        self.chunk_interval = chunk_interval
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = time.monotonic()
+
+    def append(self, message):
+        if self.truncated:
+            return  # Don't even decode what would be thrown away
+
+        size = len(message) + 1  # Count the newline too
+        if self.max_bytes is not None and self.size + size > self.max_bytes:
+            self.truncated = True
+            if self.on_truncated:
+                self.on_truncated(self)
+            return
+
+        line = message.decode('utf8', errors='replace')
+        self.lines.append(line)
+        self.size += size
+
+        if self.on_output:
+            self.pending.append(line)
+            self.pending_size += size
+            if self.pending_size >= self.chunk_bytes or time.monotonic() - self.last_flush >= self.chunk_interval:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.on_output('\n'.join(self.pending) + '\n')
+            self.pending = []
+            self.pending_size = 0
+
+        self.last_flush = time.monotonic()
+
+    def getvalue(self):
+        output = '\n'.join(self.lines)
+        if self.truncated:
+            output += '\n(output truncated after {} bytes)'.format(self.size)
+        return output
+
+
+class SQFVMInstance:
+    def __init__(self, handle, max_runtime_seconds):
+        self.handle = handle
+        self.max_runtime_seconds = max_runtime_seconds
+        self.calls = 0
+
+
+class SQFVMLibrary:
+    """ctypes bindings for a single copy of libcsqfvm loaded in the current process"""
+
+    def __init__(self, path, max_instance_calls=1, max_output_bytes=None, configs=()):
         self.sqfvm_path = path
         self.libsqfvm = None
-        self.lock = asyncio.Lock()
+        self.build_id = None
+        self.max_output_bytes = max_output_bytes
+        self.configs = list(configs)  # Contents of the config files loaded into every new instance
+
+        # Instances are created once and reused for up to max_instance_calls calls
+        self.max_instance_calls = max_instance_calls
+        self.idle_instances = []
+        self.instances_lock = threading.Lock()
+
+        # All the instances share one callback. The output of each call is told apart by its call_data
+        self.outputs = {}
+        self.call_ids = itertools.count(1)
+        self.callback = sqfvm_log_callback(self._log_callback)
 
     def ready(self):
         return self.libsqfvm is not None
 
     def unload(self):
         if self.libsqfvm:
-            unload_dll(self.libsqfvm)
+            self._release_library()
             self.libsqfvm = None
+            self.build_id = None
+
+    def _release_library(self):
+        """Destroy the idle instances and close the currently loaded library"""
+        with self.instances_lock:
+            for instance in self.idle_instances:
+                self._sqfvm_destroy_instance(instance.handle)
+            self.idle_instances = []
+
+        unload_dll(self.libsqfvm)
 
     def load(self):
         if self.libsqfvm:
             self.unload()
 
-        libsqfvm = CDLL(self.sqfvm_path)
+        self.libsqfvm = self.open_library(self.sqfvm_path)
+        self.build_id = self.get_build_id(self.sqfvm_path)
+
+    @staticmethod
+    def open_library(path):
+        libsqfvm = CDLL(path)
 
         # void* sqfvm_create_instance(void* user_data, sqfvm_log_callback callback, float max_runtime_seconds)
         libsqfvm.sqfvm_create_instance.restype = ctypes.c_void_p
@@ -53,7 +180,16 @@ class SQFVMWrapper:
         libsqfvm.sqfvm_status.restype = ctypes.c_int32
         libsqfvm.sqfvm_status.argtypes = [ctypes.c_void_p]
 
-        self.libsqfvm = libsqfvm
+        return libsqfvm
+
+    @staticmethod
+    def get_build_id(path):
+        """Identifies the library build by its contents, so a rebuild is told apart even if the path is the same"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
 
     # ==== Wrappers ===========================================================
 
@@ -86,6 +222,14 @@ class SQFVMWrapper:
 
     sqfvm_user_caused_error_codes = {-2, -3, -6}
 
+    call_type_names = {
+        ord('s'): 'sqf',
+        ord('c'): 'sqc',
+        ord('1'): 'sqf2sqc',
+        ord('a'): 'assembly',
+        ord('p'): 'preprocess',
+    }
+
     def get_error_message(self, code):
         internal = 'SQF-VM encountered an internal error'
         user_related = 'SQF-VM encountered an error while executing the code'
@@ -102,33 +246,101 @@ class SQFVMWrapper:
 
         return message
 
-    def call_type(self, code: str, timeout=10, type=ord('s')):
-        data_out = []
+    def _log_callback(self, user_data, call_data, severity, message, length):
+        output = self.outputs.get(call_data)
+        if output is None:
+            # Not part of a call, like the messages of sqfvm_load_config
+            logger.info('SQF-VM: %s', message.decode('utf8', errors='replace'))
+            return
 
-        # FIXME: Find an easy way for this to simply be a method class instead of using a closure
-        # typedef void(*sqfvm_log_callback)(void* user_data, void* call_data, int32_t severity, const char* message,
-        #                                   uint32_t length);
-        @ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int32, ctypes.c_char_p, ctypes.c_uint32)
-        def callback(user_data, call_data, severity, message, length):
-            data_out.append(message.decode('utf8'))
+        output.append(message)
 
-        if not self.ready():
-            return 'Error: SQF-VM not loaded correctly'
+    def create_instance(self, max_runtime_seconds):
+        handle = self._sqfvm_create_instance(None, self.callback, max_runtime_seconds=max_runtime_seconds)
+        if not handle:
+            return None
+
+        # This is where the configs are parsed, so it's better done in advance, by warm_up
+        for contents in self.configs:
+            retval = self._sqfvm_load_config(handle, contents, len(contents))
+            if retval != 0:
+                logger.warning('Could not load a config file: %s', self.get_error_message(retval))
+
+        return SQFVMInstance(handle, max_runtime_seconds)
+
+    def checkout_instance(self, max_runtime_seconds):
+        with self.instances_lock:
+            for i, instance in enumerate(self.idle_instances):
+                if instance.max_runtime_seconds == max_runtime_seconds:
+                    return self.idle_instances.pop(i)
+
+        return self.create_instance(max_runtime_seconds)
+
+    def checkin_instance(self, instance, retval):
+        instance.calls += 1
+
+        # Internal errors may leave the instance in a bad state, so it is only reused after a clean run
+        # (user errors included) and until it reaches its call limit
+        reusable = retval == 0 or retval in self.sqfvm_user_caused_error_codes
+        if reusable and instance.calls < self.max_instance_calls:
+            with self.instances_lock:
+                self.idle_instances.append(instance)
+        else:
+            self._sqfvm_destroy_instance(instance.handle)
+
+    def warm_up(self, count, max_runtime_seconds=10):
+        """Pre-create instances until count of them are idle, so that calls don't pay for the VM setup and the
+        parsing of the configs"""
+        with self.instances_lock:
+            idle = sum(instance.max_runtime_seconds == max_runtime_seconds for instance in self.idle_instances)
+
+        for _ in range(count - idle):
+            instance = self.create_instance(max_runtime_seconds)
+            if instance:
+                with self.instances_lock:
+                    self.idle_instances.append(instance)
+
+    def execute(self, code: str, timeout=10, type=ord('s'), on_output=None, on_truncated=None):
+        """Run the code and return (retval, output). retval is None if no instance could be created
 
+        If given, on_output is called with chunks of the output while the code is running, and on_truncated with
+        the OutputBuffer once the output is over max_output_bytes.
+        """
         code_bytes = code.encode('utf-8')
 
-        instance = self._sqfvm_create_instance(None, callback, max_runtime_seconds=timeout)
+        instance = self.checkout_instance(max_runtime_seconds=timeout)
         if not instance:
-            return 'Error: SQF-VM could not create an instance'
+            return None, ''
+
+        call_id = next(self.call_ids)
+        data_out = self.outputs[call_id] = OutputBuffer(max_bytes=self.max_output_bytes, on_output=on_output,
+                                                       on_truncated=on_truncated)
+        try:
+            retval = self._sqfvm_call(instance.handle, call_id, type, code_bytes, len(code_bytes))
+        finally:
+            del self.outputs[call_id]
 
-        retval = self._sqfvm_call(instance, None, type, code_bytes, len(code_bytes))
+        if on_output:
+            data_out.flush()
 
-        self._sqfvm_destroy_instance(instance)
+        self.checkin_instance(instance, retval)
+        return retval, data_out.getvalue()
+
+    def format_result(self, retval, output):
+        if retval is None:
+            return 'Error: SQF-VM could not create an instance'
 
         if retval != 0:
-            return '\n'.join(data_out) + '\nError: ' + self.get_error_message(retval)
+            return output + '\nError: ' + self.get_error_message(retval)
 
-        return '\n'.join(data_out)
+        return output
+
+    def call_type(self, code: str, timeout=10, type=ord('s')):
+        if not self.ready():
+            return 'Error: SQF-VM not loaded correctly'
+
+        retval, output = self.execute(code=code, timeout=timeout, type=type)
+        return self.format_result(retval, output)
 
     def call_sqf(self, code: str, timeout=10):
         return self.call_type(code=code, timeout=timeout, type=ord('s'))
@@ -145,22 +357,773 @@ class SQFVMWrapper:
     def call_preprocess(self, code: str, timeout=10):
         return self.call_type(code=code, timeout=timeout, type=ord('p'))
 
-    async def call_sqf_async(self, code: str, timeout=10):
-        async with self.lock:
-            return await asyncio.get_event_loop().run_in_executor(None, self.call_sqf, code, timeout)
 
-    async def call_sqc_async(self, code: str, timeout=10):
-        async with self.lock:
-            return await asyncio.get_event_loop().run_in_executor(None, self.call_sqc, code, timeout)
+# ==== Worker processes =======================================================
+# Every worker process loads its own copy of libcsqfvm, so that many scripts can run at the same time.
+# A call that runs past its deadline, or whose caller gives up, gets its worker killed and replaced
+
+WORKER_START_TIMEOUT = 60  # Seconds a new worker has to load the library and warm up its instances
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class _PipeLogHandler(logging.Handler):
+    """Send the log records of a worker to its parent, which logs them with its own handlers
+
+    The handlers inherited from the parent can't be used: they may write to a queue only read by a thread of the
+    parent (see modules.log_pipeline).
+    """
+
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+
+    def emit(self, record):
+        try:
+            exc_text = logging.Formatter().formatException(record.exc_info) if record.exc_info else record.exc_text
+            self.conn.send(('log', {'name': record.name, 'levelno': record.levelno, 'levelname': record.levelname,
+                                    'msg': record.getMessage(), 'created': record.created, 'exc_text': exc_text,
+                                    'process': record.process, 'processName': record.processName}))
+        except Exception:
+            self.handleError(record)
+
+
+def _worker_main(conn, path, max_instance_calls, warm_instances, max_output_bytes, configs):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_PipeLogHandler(conn))
+
+    try:
+        library = SQFVMLibrary(path, max_instance_calls=max_instance_calls, max_output_bytes=max_output_bytes,
+                               configs=configs)
+        library.load()
+        library.warm_up(warm_instances)
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+    conn.send(('ready', None))
+
+    def on_output(chunk):
+        conn.send(('output', chunk))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        code, timeout, type, stream = request
+        start = time.perf_counter()
+
+        def on_truncated(buffer):
+            # Nobody will see the rest of the output: reply now and let the pool replace this process
+            if buffer.on_output:
+                buffer.flush()
+            output = buffer.getvalue() + '\n(the script was stopped)'
+            conn.send(('stopping', None))
+            conn.send(('result', (0, output, time.perf_counter() - start)))
+            os._exit(0)
+
+        retval, output = library.execute(code=code, timeout=timeout, type=type,
+                                         on_output=on_output if stream else None, on_truncated=on_truncated)
+        conn.send(('result', (retval, output, time.perf_counter() - start)))
+
+        # Replace the instance that was used, now that the caller has its result and before the next call
+        library.warm_up(warm_instances)
+
+
+class SQFVMWorker:
+    """A worker process running one call at a time, with a thread passing its messages to the event loop"""
+
+    def __init__(self, initargs):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(child_conn,) + initargs,
+                                               name='sqfvm-worker', daemon=True)
+        self.process.start()
+        child_conn.close()  # Otherwise the pipe isn't closed when the process dies
+
+        self.dead = False
+        self.started = threading.Event()
+        self.start_error = None
+        self.start_waiter = None
+        self.loop = None
+        self.call = None  # (future, on_output) of the running call
+
+        self.reader = threading.Thread(target=self._read, name='sqfvm-worker-reader', daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        try:
+            while True:
+                kind, payload = self.conn.recv()
+                if kind in ('ready', 'error'):
+                    self.start_error = payload
+                    self._set_started()
+                elif kind == 'output':
+                    self.loop.call_soon_threadsafe(self._on_output, payload)
+                elif kind == 'stopping':
+                    self.dead = True  # Not to be given another call, even before its pipe is closed
+                elif kind == 'result':
+                    self.loop.call_soon_threadsafe(self._on_result, payload)
+                elif kind == 'log':
+                    record = logging.makeLogRecord(payload)
+                    logging.getLogger(record.name).handle(record)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.dead = True
+            self._set_started()
+            if self.loop and not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self._on_exit)
+            self.process.join()
+
+    def _set_started(self):
+        self.started.set()
+        if self.start_waiter:
+            loop, waiter = self.start_waiter
+            if not loop.is_closed():  # The process may exit after its event loop, when the bot stops
+                loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+    def _on_output(self, chunk):
+        if self.call and self.call[1]:
+            self.call[1](chunk)
+
+    def _on_result(self, result):
+        if self.call and not self.call[0].done():
+            self.call[0].set_result(result)
+
+    def _on_exit(self):
+        if self.call and not self.call[0].done():
+            self.call[0].set_exception(WorkerCrashed('exit code {}'.format(self.process.exitcode)))
+
+    async def run(self, code, timeout, type, on_output, deadline):
+        """Return (retval, output, seconds spent executing). Raises asyncio.TimeoutError after deadline seconds"""
+        self.loop = loop = asyncio.get_event_loop()
+
+        if not self.started.is_set():
+            waiter = loop.create_future()
+            self.start_waiter = (loop, waiter)
+            if not self.started.is_set():
+                await asyncio.wait_for(waiter, WORKER_START_TIMEOUT)
+
+        if self.dead or self.start_error:
+            raise WorkerCrashed(self.start_error or 'exit code {}'.format(self.process.exitcode))
+
+        future = loop.create_future()
+        self.call = (future, on_output)
+        try:
+            try:
+                self.conn.send((code, timeout, type, on_output is not None))
+            except OSError as e:
+                raise WorkerCrashed(repr(e))
+
+            return await asyncio.wait_for(future, deadline)
+        finally:
+            self.call = None
+
+    def stop(self):
+        """Let the process exit once it's done with its current call"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+
+    def kill(self):
+        self.dead = True
+        self.process.kill()
+
+
+class SQFVMWorkerPool:
+    def __init__(self, size, initargs):
+        self.initargs = initargs
+        self.idle = collections.deque(SQFVMWorker(initargs) for _ in range(size))
+        self.waiters = collections.deque()
+        self.closed = False
+
+    async def _acquire(self):
+        if self.idle:
+            worker = self.idle.popleft()
+        else:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                worker = await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release(waiter.result())  # It was handed a worker right before being cancelled
+                raise
+
+        if worker.dead:
+            worker = SQFVMWorker(self.initargs)
+        return worker
+
+    def _release(self, worker):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(worker)  # A dead worker is replaced by _acquire
+                return
+
+        if worker.dead:
+            if not self.closed:
+                self.idle.append(SQFVMWorker(self.initargs))
+        elif self.closed:
+            worker.stop()
+        else:
+            self.idle.append(worker)
+
+    async def run(self, code, timeout, type, on_output=None, deadline=None):
+        """Return (retval, output, seconds waited for a worker, seconds spent executing)
+
+        Raises asyncio.TimeoutError if the call didn't finish within deadline seconds, and WorkerCrashed if the
+        worker died. In both cases, and if the caller is cancelled, the worker is killed and replaced.
+        """
+        start = time.perf_counter()
+        worker = await self._acquire()
+        queue_wait = time.perf_counter() - start
+
+        try:
+            retval, output, execution = await worker.run(code, timeout, type, on_output, deadline)
+        except BaseException:
+            worker.kill()
+            raise
+        finally:
+            self._release(worker)
+
+        return retval, output, queue_wait, execution
+
+    def shutdown(self):
+        """Stop the idle workers now, and the others once they're done with their calls"""
+        self.closed = True
+        while self.idle:
+            self.idle.popleft().stop()
+
+
+# ==== Remote nodes ===========================================================
+# Execution nodes (sqfvm_node.py) run a worker pool on other machines. They're sent one JSON object per line,
+# over TCP or a Unix socket. Every request has an id, so that a single connection carries many calls at once
+
+NODE_MESSAGE_LIMIT = 16 * 1024 * 1024  # Bytes in a single message
+NODE_CONNECT_TIMEOUT = 5  # Seconds
+NODE_DEADLINE_MARGIN = 5  # Seconds a node has to report a call past its deadline, before the call is given up
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+def parse_node_address(address):
+    """'tcp://host:port' -> ('tcp', (host, port)), 'unix:///path/to/socket' -> ('unix', path)"""
+    parsed = urllib.parse.urlsplit(address)
+    if parsed.scheme == 'tcp' and parsed.hostname and parsed.port:
+        return 'tcp', (parsed.hostname, parsed.port)
+    if parsed.scheme == 'unix' and parsed.path:
+        return 'unix', parsed.path
+    raise ValueError('Invalid SQF-VM node address: {}'.format(address))
+
+
+async def open_node_connection(address):
+    kind, target = parse_node_address(address)
+    if kind == 'tcp':
+        return await asyncio.open_connection(*target, limit=NODE_MESSAGE_LIMIT)
+    return await asyncio.open_unix_connection(target, limit=NODE_MESSAGE_LIMIT)
+
+
+async def start_node_server(address, handler):
+    kind, target = parse_node_address(address)
+    if kind == 'tcp':
+        return await asyncio.start_server(handler, *target, limit=NODE_MESSAGE_LIMIT)
+    return await asyncio.start_unix_server(handler, target, limit=NODE_MESSAGE_LIMIT)
+
+
+def write_message(writer, message):
+    writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+
+async def read_message(reader):
+    """Return the next message. Raises EOFError once the connection is closed"""
+    line = await reader.readline()
+    if not line:
+        raise EOFError('connection closed')
+    return json.loads(line)
+
+
+class SQFVMNodeClient:
+    """Connection to an execution node, opened on first use and again after being lost"""
+
+    def __init__(self, address, token=None):
+        self.address = address
+        self.token = token
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.connect_lock = asyncio.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request id -> (future of the reply, on_output)
+        self.closing = False
+
+        # As of the last health check
+        self.checked = False
+        self.healthy = False
+        self.workers = 0
+        self.build_id = None
+        self.config_id = None
+
+        self.running = 0  # Calls sent to the node and not answered yet
+
+    async def _connect(self):
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+
+            try:
+                reader, writer = await asyncio.wait_for(open_node_connection(self.address), NODE_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.healthy = False
+                raise NodeUnavailable('Could not connect to the SQF-VM node {}: {!r}'.format(self.address, e))
+
+            write_message(writer, {'op': 'hello', 'token': self.token})
+            self.reader, self.writer = reader, writer
+            self.read_task = asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                message = await read_message(reader)
+                pending = self.pending.get(message['id'])
+                if pending is None:
+                    continue  # Given up on
+
+                future, on_output = pending
+                if message['kind'] == 'output':
+                    if on_output:
+                        on_output(message['chunk'])
+                elif not future.done():
+                    future.set_result(message)
+        except (EOFError, OSError, ValueError, KeyError) as e:
+            error = e
+
+        self._disconnect(NodeUnavailable('Lost the connection to the SQF-VM node {}: {!r}'.format(self.address, error)))
+
+    def _disconnect(self, error):
+        """Close the connection, and fail the calls waiting for a reply with the error"""
+        self.healthy = False
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+        if self.read_task is not None and self.read_task is not asyncio.current_task():
+            self.read_task.cancel()
+        self.read_task = None
+
+        for future, on_output in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self, message, on_output=None, timeout=None):
+        """Send the request and return the reply of the node
+
+        Raises NodeUnavailable if the node can't be reached or the connection is lost, and asyncio.TimeoutError
+        after timeout seconds. A call that is given up on is cancelled on the node too.
+        """
+        await self._connect()
+
+        request_id = next(self.request_ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = (future, on_output)
+        try:
+            try:
+                write_message(self.writer, dict(message, id=request_id))
+                await self.writer.drain()
+            except (AttributeError, OSError) as e:  # The writer is None if the connection was lost meanwhile
+                self._disconnect(NodeUnavailable('Lost the connection to the SQF-VM node {}'.format(self.address)))
+                raise NodeUnavailable('Could not send to the SQF-VM node {}: {!r}'.format(self.address, e))
+
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if message['op'] == 'call' and self.writer is not None:
+                write_message(self.writer, {'op': 'cancel', 'id': request_id})
+            raise
+        finally:
+            del self.pending[request_id]
+            if self.closing and not self.pending:
+                self.close()
+
+    async def check_health(self, timeout):
+        was_healthy = self.healthy
+        first_check = not self.checked
+        self.checked = True
+        try:
+            reply = await self.request({'op': 'health'}, timeout=timeout)
+        except (NodeUnavailable, asyncio.TimeoutError) as e:
+            if was_healthy or first_check:
+                logger.warning('SQF-VM node %s is down: %r', self.address, e)
+            self._disconnect(NodeUnavailable('The SQF-VM node {} is down'.format(self.address)))
+            return
+
+        self.workers = reply['workers']
+        self.build_id = reply['build_id']
+        self.config_id = reply['config_id']
+        self.healthy = True
+        if not was_healthy:
+            logger.info('SQF-VM node %s is up, with %d workers', self.address, self.workers)
+
+    def close(self):
+        """Close the connection once the calls already sent are answered"""
+        self.closing = True
+        if not self.pending:
+            self._disconnect(NodeUnavailable('The connection to the SQF-VM node {} was closed'.format(self.address)))
+
+
+class SQFVMRemotePool:
+    """Drop-in replacement for SQFVMWorkerPool, running the calls on execution nodes
+
+    Each call goes to the healthy node with the fewest calls running per worker. If a node can't be reached, the
+    call is sent to another one, unless some of its output was already received.
+    """
+
+    def __init__(self, addresses, token=None, health_interval=5, on_health_change=None):
+        self.nodes = [SQFVMNodeClient(address, token) for address in addresses]
+        self.health_interval = health_interval
+        self.on_health_change = on_health_change
+        self.health_task = asyncio.ensure_future(self._check_health())
+
+    def _state(self):
+        return [(node.healthy, node.workers, node.build_id, node.config_id) for node in self.nodes]
+
+    async def _check_health(self):
+        while True:
+            before = self._state()
+            await asyncio.gather(*(node.check_health(self.health_interval) for node in self.nodes))
+            if self._state() != before and self.on_health_change:
+                self.on_health_change()
+            await asyncio.sleep(self.health_interval)
+
+    def capacity(self):
+        """Number of calls the healthy nodes can run at the same time"""
+        return sum(node.workers for node in self.nodes if node.healthy)
+
+    @property
+    def build_id(self):
+        """Identifies the builds and configs of the healthy nodes, None if there's none"""
+        builds = {'{}/{}'.format(node.build_id, node.config_id) for node in self.nodes if node.healthy}
+        return '+'.join(sorted(builds)) or None
+
+    def _pick(self, excluded):
+        candidates = [node for node in self.nodes if node.healthy and node not in excluded]
+        if not candidates:
+            raise NodeUnavailable('No SQF-VM node available')
+        return min(candidates, key=lambda node: (node.running / max(node.workers, 1), random.random()))
+
+    async def run(self, code, timeout, type, on_output=None, deadline=None):
+        """Return (retval, output, seconds waited for a worker, seconds spent executing)
+
+        Raises the same exceptions as SQFVMWorkerPool.run, and NodeUnavailable when no node could run the call
+        """
+        start = time.perf_counter()
+        request = {'op': 'call', 'code': code, 'timeout': timeout, 'type': type, 'stream': on_output is not None,
+                   'deadline': deadline}
+        reply_timeout = deadline + NODE_DEADLINE_MARGIN if deadline is not None else None
+        received_output = False
+
+        def forward_output(chunk):
+            nonlocal received_output
+            received_output = True
+            on_output(chunk)
+
+        tried = set()
+        while True:
+            node = self._pick(tried)
+            tried.add(node)
+            node.running += 1
+            try:
+                reply = await node.request(request, forward_output if on_output else None, reply_timeout)
+                break
+            except NodeUnavailable as e:
+                if received_output:
+                    raise WorkerCrashed(str(e))  # The output can't be taken back
+                logger.warning('%s, sending the call to another node', e)
+            finally:
+                node.running -= 1
+
+        if reply['kind'] == 'error':
+            if reply['error'] == 'deadline':
+                raise asyncio.TimeoutError()
+            raise WorkerCrashed('{} on node {}'.format(reply['message'], node.address))
+
+        execution = reply['execution']
+        return reply['retval'], reply['output'], time.perf_counter() - start - execution, execution
+
+    def shutdown(self):
+        """Stop the health checks, and close the connections once their calls are answered"""
+        self.health_task.cancel()
+        for node in self.nodes:
+            node.close()
+
+
+class SharedExecution:
+    """Execution of a call shared by identical calls, streaming its output to each of them"""
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0  # Callers waiting for the result
+        self.chunks = []  # Output so far, for the callers joining later
+        self.subscribers = []  # on_output of the callers still waiting
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        for on_output in list(self.subscribers):
+            on_output(chunk)
+
+
+class SQFVMWrapper(SQFVMLibrary):
+    def __init__(self, path, workers=None, max_instance_calls=1, warm_instances=0, max_output_bytes=None,
+                 cached_types=(), cache_max_entries=1000, cache_max_bytes=None, config_files=(), deadline_grace=5,
+                 nodes=(), node_token=None, health_interval=5):
+        super().__init__(path, max_instance_calls=max_instance_calls, max_output_bytes=max_output_bytes)
+        self.workers = workers or os.cpu_count() or 1
+        self.warm_instances = warm_instances
+        self.pool = None
+
+        # Addresses of execution nodes running the calls instead of local workers. The library isn't loaded then
+        self.nodes = list(nodes)
+        self.node_token = node_token
+        self.health_interval = health_interval
+        # Seconds a call may run past its own timeout before its worker is killed, in case SQF-VM doesn't stop it
+        self.deadline_grace = deadline_grace
+
+        # Config files loaded into every instance of the workers. They're read again when they change
+        self.config_files = list(config_files)
+        self.config_mtimes = {}  # path -> mtime when it was read, None if it couldn't be read
+        self.config_id = None
+
+        # Results of the call types that always give the same output for the same code
+        self.cached_types = set(cached_types)
+        self.results_cache = LRUCache(max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+        self.in_flight = {}  # cache key -> SharedExecution
+
+    def ready(self):
+        if self.nodes:
+            return self.pool is not None and self.pool.capacity() > 0
+        return super().ready() and self.pool is not None
+
+    def capacity(self):
+        """Number of calls that can run at the same time"""
+        if self.nodes:
+            return self.pool.capacity() if self.pool else 0
+        return self.workers
+
+    def _on_nodes_changed(self):
+        # Results from another build, or other configs, can't be reused
+        if self.pool.build_id != self.build_id:
+            logger.info('SQF-VM builds on the nodes: %s', self.pool.build_id)
+            self.build_id = self.pool.build_id
+            self.results_cache.clear()
+
+    def _create_pool(self):
+        if self.nodes:
+            return SQFVMRemotePool(self.nodes, token=self.node_token, health_interval=self.health_interval,
+                                   on_health_change=self._on_nodes_changed)
+
+        return SQFVMWorkerPool(self.workers, (self.sqfvm_path, self.max_instance_calls, self.warm_instances,
+                                              self.max_output_bytes, self.configs))
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def read_configs(self):
+        configs = []
+        mtimes = {}
+        digest = hashlib.sha256()
+        for path in self.config_files:
+            mtimes[path] = self._get_mtime(path)
+            try:
+                with open(path, 'rb') as f:
+                    contents = f.read()
+            except OSError as e:
+                logger.error('Could not read the config file %s: %s', path, e)
+                continue
+
+            configs.append(contents)
+            digest.update(hashlib.sha256(contents).digest())
+
+        self.configs = configs
+        self.config_mtimes = mtimes
+        self.config_id = digest.hexdigest()
+
+    def configs_changed(self):
+        return any(self._get_mtime(path) != mtime for path, mtime in self.config_mtimes.items())
+
+    def reload_configs(self):
+        """Read the config files again and restart the workers with them
+
+        Like swap(), calls already running finish in the old workers.
+        """
+        self.read_configs()
+        self._replace_pool()
+
+    def _replace_pool(self):
+        """Send the new calls to new workers, and let the old ones exit after finishing their calls"""
+        old_pool = self.pool
+        self.pool = self._create_pool()
+        self.results_cache.clear()
+
+        if old_pool:
+            old_pool.shutdown()
+
+    def unload(self):
+        if self.pool:
+            # Calls that are already running in the workers are allowed to finish
+            self.pool.shutdown()
+            self.pool = None
+
+        super().unload()
+
+    def load(self):
+        if self.nodes:
+            self.pool = self._create_pool()
+            return
+
+        # Load the library in this process too, so that a broken build fails here and not in every worker
+        super().load()
+        self.read_configs()
+        self.pool = self._create_pool()
+
+        # Cache keys contain the build id so they can't match anyway. This just frees the memory
+        self.results_cache.clear()
+
+    def swap(self, path):
+        """Start serving new calls from another build of the library, without any downtime
+
+        Calls already running finish in the old workers, which then exit. If the new library can't be loaded,
+        an exception is raised and the current one stays in place.
+        Use a file name that has never been loaded before: loading the same path again may give back the library
+        that is already in memory instead of the new build.
+        """
+        if self.nodes:
+            raise RuntimeError('SQF-VM runs on the execution nodes, it has to be rebuilt there')
+
+        libsqfvm = self.open_library(path)
+        build_id = self.get_build_id(path)
+
+        if self.libsqfvm:
+            self._release_library()
+
+        self.sqfvm_path = path
+        self.libsqfvm = libsqfvm
+        self.build_id = build_id
+        self.read_configs()  # Also picks up the config files updated with the build
+        self._replace_pool()
+
+    def cache_key(self, code, type, timeout):
+        # The timeout is part of the key, since a call that ran out of time has a different (user-caused) result
+        return type, hashlib.sha256(code.encode('utf-8')).hexdigest(), timeout, self.build_id, self.config_id
+
+    async def call_type_async(self, code: str, timeout=10, type=ord('s'), on_output=None):
+        """Run the code in a worker process
+
+        If given, on_output is called on the event loop with chunks of the output while the code is running.
+        The returned result always contains the whole (capped) output
+        """
+        if not self.ready():
+            return 'Error: SQF-VM not loaded correctly'
+
+        if type not in self.cached_types:
+            return await self._execute_async(code, timeout, type, on_output)
+
+        type_name = self.call_type_names.get(type, str(type))
+        key = self.cache_key(code, type, timeout)
+        result = self.results_cache.get(key)
+        if result is not None:
+            SQFVM_CACHE_HITS.inc(type=type_name)
+            return result
+
+        # The same deterministic call is already running: wait for its result instead of running it again.
+        # It runs in its own task, so that it's only cancelled once every caller waiting for it has been
+        flight = self.in_flight.get(key)
+        if flight is None:
+            flight = self.in_flight[key] = SharedExecution()
+            flight.task = asyncio.ensure_future(self._execute_async(code, timeout, type, flight.feed, cache_key=key))
+            flight.task.add_done_callback(lambda _: self._end_flight(key, flight))
+        else:
+            SQFVM_COALESCED.inc(type=type_name)
+
+        if on_output:
+            for chunk in flight.chunks:
+                on_output(chunk)
+            flight.subscribers.append(on_output)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if on_output:
+                flight.subscribers.remove(on_output)  # A caller that gave up stops receiving the output
+            if not flight.waiters and not flight.task.done():
+                # Right away, so that the same call made before the task is done starts again instead of joining it
+                self._end_flight(key, flight)
+                flight.task.cancel()
+
+    def _end_flight(self, key, flight):
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+    async def _execute_async(self, code, timeout, type, on_output, cache_key=None):
+        """Run the code in a worker process, and cache the result under cache_key if given
+
+        Cancelling this stops the code, by killing the worker running it.
+        """
+        type_name = self.call_type_names.get(type, str(type))
+        try:
+            retval, output, queue_wait, execution = await self.pool.run(code, timeout, type, on_output,
+                                                                        deadline=timeout + self.deadline_grace)
+        except asyncio.TimeoutError:
+            logger.warning('SQF-VM call still running %ss after its timeout, its worker was killed',
+                           self.deadline_grace)
+            SQFVM_CALLS.inc(type=type_name, code='deadline')
+            return 'Error: SQF-VM did not stop in time and was killed'
+        except WorkerCrashed as e:
+            logger.error('SQF-VM worker process died: %s', e)
+            SQFVM_CALLS.inc(type=type_name, code='crashed')
+            return 'Error: SQF-VM crashed while executing the code'
+        except NodeUnavailable as e:
+            logger.error('%s', e)
+            SQFVM_CALLS.inc(type=type_name, code='no_node')
+            return 'Error: no SQF-VM node is available, try again later'
+
+        code_label = 'no_instance' if retval is None else retval
+        SQFVM_CALLS.inc(type=type_name, code=code_label)
+        SQFVM_QUEUE_WAIT.observe(queue_wait, type=type_name)
+        SQFVM_EXECUTION.observe(execution, type=type_name, code=code_label)
+        SQFVM_OUTPUT.observe(len(output.encode('utf-8')), type=type_name)
+
+        result = self.format_result(retval, output)
+
+        # Internal errors may not happen again, so don't remember them
+        if cache_key is not None and (retval == 0 or retval in self.sqfvm_user_caused_error_codes):
+            self.results_cache.put(cache_key, result)
+
+        return result
+
+    async def call_sqf_async(self, code: str, timeout=10, on_output=None):
+        return await self.call_type_async(code=code, timeout=timeout, type=ord('s'), on_output=on_output)
+
+    async def call_sqc_async(self, code: str, timeout=10, on_output=None):
+        return await self.call_type_async(code=code, timeout=timeout, type=ord('c'), on_output=on_output)
 
-    async def call_sqf2sqc_async(self, code: str, timeout=10):
-        async with self.lock:
-            return await asyncio.get_event_loop().run_in_executor(None, self.call_sqf2sqc, code, timeout)
+    async def call_sqf2sqc_async(self, code: str, timeout=10, on_output=None):
+        return await self.call_type_async(code=code, timeout=timeout, type=ord('1'), on_output=on_output)
 
-    async def call_assembly_async(self, code: str, timeout=10):
-        async with self.lock:
-            return await asyncio.get_event_loop().run_in_executor(None, self.call_assembly, code, timeout)
+    async def call_assembly_async(self, code: str, timeout=10, on_output=None):
+        return await self.call_type_async(code=code, timeout=timeout, type=ord('a'), on_output=on_output)
 
-    async def call_preprocess_async(self, code: str, timeout=10):
-        async with self.lock:
-            return await asyncio.get_event_loop().run_in_executor(None, self.call_preprocess, code, timeout)
+    async def call_preprocess_async(self, code: str, timeout=10, on_output=None):
+        return await self.call_type_async(code=code, timeout=timeout, type=ord('p'), on_output=on_output)
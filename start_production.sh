@@ -3,6 +3,8 @@
 branch=master
 remote_branch="origin/${branch}"
 python=python
+requirements="`dirname $0`/requirements/base.txt"
+requirements_hash_file="`dirname $0`/.requirements.sha256"
 
 while true
 do
@@ -12,7 +14,11 @@ do
   git checkout "${branch}"
   git reset --hard "${remote_branch}"
   git pull
-  "${python}" -m pip install -r "`dirname $0`/requirements/base.txt"
+  # Only reinstall the dependencies when they have changed since the last successful install
+  requirements_hash=`{ cat "${requirements}"; "${python}" --version; } | sha256sum | cut -d " " -f 1`
+  if [ "${requirements_hash}" != "`cat "${requirements_hash_file}" 2>/dev/null`" ]; then
+    "${python}" -m pip install -r "${requirements}" && echo "${requirements_hash}" > "${requirements_hash_file}"
+  fi
   "${python}" "`dirname $0`/main.py"
 
   sleep 5